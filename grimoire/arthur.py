@@ -23,21 +23,29 @@
 #   Alvaro del Castillo San Felix <acs@bitergia.com>
 #
 
+from concurrent.futures import ProcessPoolExecutor
 from datetime import datetime
 from dateutil import parser
+import json
 import logging
-import requests
 
 
+from grimoire.elk.elastic import BulkWriter, ElasticSearch
+from grimoire.elk.identities import IdentityCollector
 from grimoire.elk.sortinghat import SortingHat
-from grimoire.ocean.conf import ConfOcean
+from grimoire.ocean.conf import ConfOcean, EnrichCheckpoint
 from grimoire.utils import get_elastic
 from grimoire.utils import get_connectors, get_connector_from_name
 import traceback
 
 def feed_backend(url, clean, fetch_cache, backend_name, backend_params,
-                 es_index=None, es_index_enrich=None, project=None):
-    """ Feed Ocean with backend data """
+                 es_index=None, es_index_enrich=None, project=None,
+                 last_updates=None):
+    """ Feed Ocean with backend data
+
+        last_updates has the last update of the origins in es_index, read
+        for all the backends at once.
+    """
 
     backend = None
     repo = {}    # repository data to be stored in conf
@@ -75,12 +83,12 @@ def feed_backend(url, clean, fetch_cache, backend_name, backend_params,
             if backend_cmd.from_date.replace(tzinfo=None) == \
                 parser.parse("1970-01-01").replace(tzinfo=None):
                 # Don't use the default value
-                ocean_backend.feed()
+                ocean_backend.feed(last_updates=last_updates)
             else:
-                ocean_backend.feed(backend_cmd.from_date)
+                ocean_backend.feed(backend_cmd.from_date, last_updates)
         except AttributeError:
             # The backend does not support from_date
-            ocean_backend.feed()
+            ocean_backend.feed(last_updates=last_updates)
 
     except Exception as ex:
         if backend:
@@ -112,132 +120,280 @@ def feed_backend(url, clean, fetch_cache, backend_name, backend_params,
     logging.info("Done %s " % (backend_name))
 
 
-def get_items_from_uuid(uuid, enrich_backend, ocean_backend):
-    """ Get all items that include uuid """
-
-    # logging.debug("Getting items for merged uuid %s "  % (uuid))
-
-    uuid_fields = enrich_backend.get_fields_uuid()
-
-    terms = ""  # all terms with uuids in the enriched item
-
-    for field in uuid_fields:
-        terms += """
-         {"term": {
-           "%s": {
-              "value": "%s"
-           }
-         }}
-         """ % (field, uuid)
-        terms += ","
-
-    terms = terms[:-1]  # remove last , for last item
-
-    query = """
-    {"query": { "bool": { "should": [%s] }}}
-    """ % (terms)
-
-    url_search = enrich_backend.elastic.index_url+"/_search"
-    url_search +="?size=1000"  # TODO get all items
+def get_items_from_uuids(uuids, enrich_backend, ocean_backend,
+                         uuids_batch=1000, mget_size=1000):
+    """ Get all items that include any of uuids
 
-    r = requests.post(url_search, data=query)
+        The enriched items with uuids are found with a terms query for each
+        batch of uuids, reading all the results with a scroll. The raw items
+        for them are read from ocean with _mget in packs of mget_size.
+    """
 
-    eitems = r.json()['hits']['hits']
+    if not uuids:
+        return
 
-    if len(eitems) == 0:
-        # logging.warning("No enriched items found for uuid: %s " % (uuid))
-        return []
-
-    items_ids = []
-
-    for eitem in eitems:
-        item_id = enrich_backend.get_item_id(eitem)
-        # For one item several eitems could be generated
-        if item_id not in items_ids:
-            items_ids.append(item_id)
+    uuids = list(set(uuids))
+    uuid_fields = enrich_backend.get_fields_uuid()
+    if not uuid_fields:
+        # The enriched items have no unique identities
+        return
+    # Just the fields needed to get the raw item id from the enriched one
+    source = enrich_backend.get_fields_item_id() or False
+
+    items_ids = set()  # For one item several eitems could be generated
+    pending_ids = []
+    nitems = 0
+
+    for i in range(0, len(uuids), uuids_batch):
+        terms = [{"terms": {field: uuids[i:i + uuids_batch]}}
+                 for field in uuid_fields]
+        query = {"query": {"bool": {"should": terms}}, "_source": source}
+
+        for eitem in enrich_backend.elastic.scroll(json.dumps(query)):
+            item_id = enrich_backend.get_item_id(eitem)
+            if item_id in items_ids:
+                continue
+            items_ids.add(item_id)
+            pending_ids.append(item_id)
+            if len(pending_ids) >= mget_size:
+                for item in ocean_backend.elastic.mget(pending_ids):
+                    nitems += 1
+                    yield item
+                pending_ids = []
+
+    for item in ocean_backend.elastic.mget(pending_ids):
+        nitems += 1
+        yield item
+
+    logging.debug("Items to be renriched for %i merged uuids: %i" %
+                  (len(uuids), nitems))
+
+
+# Enricher used by each process of the enrich workers pool
+_worker_enrich = None
+_worker_backend = None
+
+def _enrich_worker_init(backend_name, backend_params, url, index,
+                        db_sortinghat, prjs_map, sh_map, enrollments_index):
+    """ Create the enricher of a worker process """
+    global _worker_enrich, _worker_backend
 
-    # Time to get the items
-    logging.debug ("Items to be renriched for merged uuids: %s" % (",".join(items_ids)))
+    connector = get_connector_from_name(backend_name)
+    backend = connector[3](*backend_params).backend
+    _worker_backend = backend
+    # Sorting Hat is only used for identities not found in sh_map
+    _worker_enrich = connector[2](backend, None, db_sortinghat)
+    # Enrichers can read caches from the index (github geolocations)
+    _worker_enrich.set_elastic(ElasticSearch(url, index))
+    _worker_enrich.prjs_map = prjs_map
+    # The store connection can't be shared with the parent process
+    _worker_enrich.identities_store = None
+    _worker_enrich.set_sh_map(sh_map)
+    _worker_enrich.set_enrollments_index(enrollments_index)
+
+def _enrich_worker(items):
+    """ Enrich items in a worker process returning them as bulk chunks,
+        with the data cached by the enricher for them """
+
+    field_id = _worker_enrich.get_field_unique_id()
+    chunks = []
+    for item in items:
+        for eitem in _worker_enrich.get_rich_items(item):
+            chunks.append(BulkWriter.encode_item(eitem, eitem[field_id]))
+    return chunks, _worker_enrich.get_new_cache()
+
+def _enrich_slice(backend_name, url, ocean_index, slice_id, slices,
+                  from_date=None):
+    """ Enrich a slice of the ocean index in a worker process """
 
-    url_mget = ocean_backend.elastic.index_url+"/_mget"
+    connector = get_connector_from_name(backend_name)
+    ocean_slice = connector[1](_worker_backend, from_date=from_date)
+    ocean_slice.set_elastic(ElasticSearch(url, ocean_index))
+    ocean_slice.set_slice(slice_id, slices)
+
+    total = 0
+    def count_items():
+        nonlocal total
+        for item in ocean_slice:
+            total += 1
+            yield item
+
+    # enrich_items_done is called for the slice (github geolocations)
+    _worker_enrich.enrich_items(count_items())
+    return total
+
+def enrich_items_workers(items, enrich_backend, backend_name, backend_params,
+                         workers, sh_map=None, batch_size=100,
+                         checkpoint=None):
+    """ Enrich items in a pool of worker processes
+
+        Items are sent to the workers in batches and the enriched items
+        are uploaded in the order of the batches. Just workers * 2 batches
+        are pending at a time so the items are not all read in memory.
+        The checkpoint is committed after the batches uploaded.
+    """
+
+    initargs = (backend_name, backend_params, enrich_backend.elastic.url,
+                enrich_backend.elastic.index, enrich_backend.db_sortinghat,
+                enrich_backend.prjs_map, sh_map,
+                enrich_backend.enrollments_index)
+
+    def get_batches():
+        batch = []
+        for item in items:
+            batch.append(item)
+            if len(batch) >= batch_size:
+                yield batch
+                batch = []
+        if batch:
+            yield batch
+
+    def add_batch(future, mark):
+        chunks, cache = future.result()
+        if cache:
+            # Kept with the items uploaded (github geolocations)
+            enrich_backend.add_new_cache(cache)
+        for chunk in chunks:
+            bulk.add_chunk(chunk)
+        if mark:
+            bulk.add_mark(mark)
+
+    total = 0
+    commit = checkpoint.commit if checkpoint else None
+    bulk = BulkWriter(enrich_backend.elastic, enrich_backend.type_name,
+                      commit=commit)
+    with ProcessPoolExecutor(max_workers=workers, initializer=_enrich_worker_init,
+                             initargs=initargs) as executor, bulk:
+        pending = []  # (future, mark) for the batches in order
+        for batch in get_batches():
+            total += len(batch)
+            mark = None
+            if checkpoint:
+                for item in batch:
+                    mark = checkpoint.mark(item)
+            pending.append((executor.submit(_enrich_worker, batch), mark))
+            if len(pending) >= workers * 2:
+                add_batch(*pending.pop(0))
+        for future, mark in pending:
+            add_batch(future, mark)
+
+    if checkpoint and bulk.stats['undelivered'] > 0:
+        checkpoint.block()
+    enrich_backend.enrich_items_done()
+
+    logging.debug("%i items enriched by %i workers: %i indexed, %i failed" %
+                  (total, workers, bulk.stats['ok'], bulk.stats['failed']))
+
+    return total
 
-    items_ids_query = ""
+def enrich_backend(url, clean, backend_name, backend_params, ocean_index=None,
+                   ocean_index_enrich = None,
+                   db_projects_map=None, db_sortinghat=None,
+                   no_incremental=False, slices=0, workers=0,
+                   merge_identities=False):
+    """ Enrich Ocean index. With slices, it is read and enriched in parallel
 
-    for item_id in items_ids:
-        items_ids_query += '{"_id" : "%s"}' % (item_id)
-        items_ids_query += ","
-    items_ids_query = items_ids_query[:-1]  # remove last , for last item
+        With workers, items are enriched in a pool of processes. Sorting Hat
+        identities are resolved before so workers don't need to query it.
+        With merge_identities, new identities are merged in Sorting Hat with
+        the matching ones.
+    """
 
-    query = '{"docs" : [%s]}' % (items_ids_query)
-    r = requests.post(url_mget, data=query)
+    def enrich_items(items, enrich_backend, checkpoint=None):
+        """ Enrich all the items in a single BulkWriter, returning how many """
 
-    res_items = r.json()['docs']
+        total = {"items": 0}
 
-    items = []
-    for res_item in res_items:
-        if res_item['found']:
-            items.append(res_item["_source"])
+        def count_items():
+            for item in items:
+                total["items"] += 1
+                if total["items"] % 10000 == 0:
+                    logging.info("%i items enriched to %s" %
+                                 (total["items"], enrich_backend.elastic.index_url))
+                yield item
 
-    return items
+        enrich_backend.enrich_items(count_items(), checkpoint)
 
+        return total["items"]
 
-def enrich_backend(url, clean, backend_name, backend_params, ocean_index=None,
-                   ocean_index_enrich = None,
-                   db_projects_map=None, db_sortinghat=None,
-                   no_incremental=False):
-    """ Enrich Ocean index """
+    def enrich_slices(elastic_ocean, enrich_backend, sh_map=None):
+        """ Enrich in parallel the slices of the ocean index, each one
+            in its own process with its own enricher """
 
-    def enrich_items(items, enrich_backend):
-        total = 0
+        initargs = (backend_name, backend_params, enrich_backend.elastic.url,
+                    enrich_backend.elastic.index, enrich_backend.db_sortinghat,
+                    enrich_backend.prjs_map, sh_map,
+                    enrich_backend.enrollments_index)
 
-        items_pack = []
+        with ProcessPoolExecutor(max_workers=slices,
+                                 initializer=_enrich_worker_init,
+                                 initargs=initargs) as executor:
+            futures = [executor.submit(_enrich_slice, backend_name,
+                                       elastic_ocean.url, elastic_ocean.index,
+                                       slice_id, slices, last_enrich)
+                       for slice_id in range(slices)]
+            totals = [future.result() for future in futures]
 
-        for item in items:
-            # print("%s %s" % (item['url'], item['lastUpdated_date']))
-            if len(items_pack) >= enrich_backend.elastic.max_items_bulk:
-                logging.info("Adding %i (%i done) enriched items to %s" % \
-                             (enrich_backend.elastic.max_items_bulk, total,
-                              enrich_backend.elastic.index_url))
-                enrich_backend.enrich_items(items_pack)
-                items_pack = []
-            items_pack.append(item)
-            total += 1
-        enrich_backend.enrich_items(items_pack)
+        for slice_id, total in enumerate(totals):
+            logging.debug("Slice %i/%i: %i items enriched" %
+                          (slice_id, len(totals), total))
 
-        return total
+        return sum(totals)
 
     def enrich_sortinghat(backend_name, ocean_backend, enrich_backend):
         # First we add all new identities to SH
         item_count = 0
-        new_identities = []
-
-        for item in ocean_backend:
+        new_identities = IdentityCollector()
+
+        # Read from the raw items just the fields with identities
+        fields = enrich_backend.get_fields_raw_identities()
+        raw_items = ocean_backend
+        if fields == []:
+            # The raw items have no identities (jenkins, stackexchange)
+            raw_items = []
+        else:
+            ocean_backend.set_source_fields(fields)
+        for item in raw_items:
             item_count += 1
             # Get identities from new items to be added to SortingHat
-            identities = enrich_backend.get_identities(item)
-            for identity in identities:
-                if identity not in new_identities:
-                    new_identities.append(identity)
+            new_identities.add_all(enrich_backend.get_identities(item))
             if item_count % 1000 == 0:
                 logging.debug("Processed %i items identities (%i identities)" \
                                % (item_count, len(new_identities)))
-        logging.debug("TOTAL ITEMS: %i" % (item_count))
+        if fields != []:
+            ocean_backend.set_source_fields(None)
+        logging.debug("TOTAL ITEMS: %i (%i identities found)" %
+                      (item_count, new_identities.total))
 
         logging.info("Total new identities to be checked %i" % len(new_identities))
 
+        sh_identities = new_identities
+        if enrich_backend.identities_store:
+            # Identities stored in previous runs are already in Sorting Hat
+            sh_identities = (identity for identity in new_identities
+                             if not enrich_backend.is_identity_stored(identity,
+                                                                      backend_name))
+
+        uuids = {}
         merged_identities = SortingHat.add_identities(enrich_backend.sh_db,
-                                                      new_identities, backend_name)
+                                                      sh_identities, backend_name,
+                                                      uuids, merge_identities)
+        # Enrich without asking Sorting Hat again for these identities
+        enrich_backend.add_uuids(uuids)
+        # uuids changed by the merges must be read again from Sorting Hat
+        enrich_backend.invalidate_identities(merged_identities)
+        # Organizations for the item dates, with the new enrollments too
+        enrich_backend.load_enrollments_index()
 
         # Redo enrich for items with new merged identities
-        renrich_items = []
         # For testing
         # merged_identities = ['7e0bcf6ff46848403eaffa29ef46109f386fa24b']
-        for mid in merged_identities:
-            renrich_items += get_items_from_uuid(mid, enrich_backend, ocean_backend)
+        renrich_items = get_items_from_uuids(merged_identities, enrich_backend,
+                                             ocean_backend)
 
         # Enrich items with merged identities
         enrich_count_merged = enrich_items(renrich_items, enrich_backend)
-        return enrich_count_merged
+        return enrich_count_merged, new_identities
 
 
     backend = None
@@ -248,6 +404,8 @@ def enrich_backend(url, clean, backend_name, backend_params, ocean_index=None,
 
     if not get_connector_from_name(backend_name):
         raise RuntimeError("Unknown backend %s" % backend_name)
+    if workers > 1 and slices > 1:
+        raise RuntimeError("Enrich workers and slices can't be used together")
     connector = get_connector_from_name(backend_name)
     klass = connector[3]  # BackendCmd for the connector
 
@@ -266,18 +424,37 @@ def enrich_backend(url, clean, backend_name, backend_params, ocean_index=None,
         enrich_backend = connector[2](backend, db_projects_map, db_sortinghat)
         elastic_enrich = get_elastic(url, enrich_index, clean, enrich_backend)
         enrich_backend.set_elastic(elastic_enrich)
+        ConfOcean.set_elastic(elastic_enrich)
+
+        checkpoint = None
+        if slices <= 1:
+            # The raw items are enriched in order, so the enrichment can
+            # go on from the last raw item enriched (not with slices)
+            checkpoint = EnrichCheckpoint(backend_name, backend.origin,
+                                          enrich_index)
 
-        # We need to enrich from just updated items since last enrichment
         # Always filter by origin to support multi origin indexes
         filter_ = {"name":"origin",
                    "value":backend.origin}
-        last_enrich = enrich_backend.get_last_update_from_es(filter_)
-        if no_incremental:
-            last_enrich = None
+        if checkpoint and (clean or not elastic_enrich.count(filter_)):
+            # No enriched items for the origin (new or removed index): the
+            # checkpoint of the items enriched before is not valid
+            checkpoint.remove()
 
-        logging.debug("Last enrichment: %s" % (last_enrich))
+        last_enrich = None
+        if no_incremental:
+            logging.debug("Enriching all the items")
+        elif checkpoint and checkpoint.load():
+            logging.debug("Last raw item enriched: %s" % (checkpoint.timestamp))
+        else:
+            # We need to enrich from just updated items since last enrichment
+            last_enrich = enrich_backend.get_last_update_from_es(filter_)
+            logging.debug("Last enrichment: %s" % (last_enrich))
 
         ocean_backend = connector[1](backend, from_date=last_enrich)
+        if checkpoint:
+            ocean_backend.set_timestamp_order(checkpoint.timestamp,
+                                              checkpoint.ids)
         clean = False  # Don't remove ocean index when enrich
         elastic_ocean = get_elastic(url, ocean_index, clean, ocean_backend)
         ocean_backend.set_elastic(elastic_ocean)
@@ -285,15 +462,32 @@ def enrich_backend(url, clean, backend_name, backend_params, ocean_index=None,
         logging.info("Adding enrichment data to %s" %
                      (enrich_backend.elastic.index_url))
 
+        sh_map = None
         if db_sortinghat:
             enrich_count_merged = 0
+            enrich_backend.load_identities_store()
 
-            enrich_count_merged = enrich_sortinghat(backend_name,
-                                                    ocean_backend, enrich_backend)
+            enrich_count_merged, identities = \
+                enrich_sortinghat(backend_name, ocean_backend, enrich_backend)
             logging.info("Total items enriched for merged identities %i " %  enrich_count_merged)
+            if workers > 1 or slices > 1:
+                sh_map = enrich_backend.get_sh_map(identities, backend_name)
+            identities.close()
         # Enrichment for the new items once SH update is finished
-        enrich_count = enrich_items(ocean_backend, enrich_backend)
+        if workers > 1:
+            enrich_count = enrich_items_workers(ocean_backend, enrich_backend,
+                                                backend_name, backend_params,
+                                                workers, sh_map,
+                                                checkpoint=checkpoint)
+        elif slices > 1:
+            enrich_count = enrich_slices(elastic_ocean, enrich_backend, sh_map)
+        else:
+            enrich_count = enrich_items(ocean_backend, enrich_backend,
+                                        checkpoint)
         logging.info("Total items enriched %i " %  enrich_count)
+        if db_sortinghat:
+            enrich_backend.save_identities_store()
+            enrich_backend.log_identities_cache_stats()
 
 
     except Exception as ex:
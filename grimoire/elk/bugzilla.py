@@ -23,19 +23,18 @@
 #   Alvaro del Castillo San Felix <acs@bitergia.com>
 #
 
-from time import time
-from dateutil import parser
-import json
 import logging
-import requests
 from urllib.parse import urlparse
 
+from .dates import parse_date
 from .enrich import Enrich
 
 from .utils import get_time_diff_days
 
 class BugzillaEnrich(Enrich):
 
+    type_name = "issues"  # ES type for the enriched items
+
     def __init__(self, bugzilla, sortinghat=True, db_projects_map = None):
         super().__init__(sortinghat, db_projects_map)
         self.perceval_backend = bugzilla
@@ -96,21 +95,17 @@ class BugzillaEnrich(Enrich):
             identity = BugzillaEnrich.get_sh_identity({'assigned_to':item["data"]['assigned_to']})
             eitem['assigned_to_uuid'] = self.get_uuid(identity, self.get_connector_name())
             eitem['assigned_to_name'] = identity['name']
-            enrollments = self.get_enrollments(eitem['assigned_to_uuid'])
-            if len(enrollments) > 0:
-                eitem["assigned_to_org_name"] = enrollments[0].organization.name
-            else:
-                eitem["assigned_to_org_name"] = None
+            eitem["assigned_to_org_name"] = \
+                self.get_enrollment(eitem['assigned_to_uuid'],
+                                    parse_date(item['metadata__updated_on']))
 
         if 'reporter' in item['data']:
             identity = BugzillaEnrich.get_sh_identity({'reporter':item["data"]['reporter']})
             eitem['reporter_uuid'] = self.get_uuid(identity, self.get_connector_name())
             eitem['reporter_name'] = identity['name']
-            enrollments = self.get_enrollments(eitem['reporter_uuid'])
-            if len(enrollments) > 0:
-                eitem["reporter_org_name"] = enrollments[0].organization.name
-            else:
-                eitem["reporter_org_name"] = None
+            creation_date = parse_date(item['data']['creation_ts'][0]['__text__'])
+            eitem["reporter_org_name"] = \
+                self.get_enrollment(eitem['reporter_uuid'], creation_date)
             if identity['email']:
                 try:
                     eitem["reporter_domain"] = identity['email'].split("@")[1]
@@ -135,12 +130,11 @@ class BugzillaEnrich(Enrich):
         # https://bugs.eclipse.org/bugs/buglist.cgi?product=Mylyn%20Tasks
         product = item['data']['product'][0]['__text__']
         repo = url+"/buglist.cgi?product="+product
-        try:
-            project = (self.prjs_map[ds_name][repo])
-        except KeyError:
-            # logging.warning("Project not found for repository %s" % (repo))
-            project = None
-        return {"project": project}
+        return {"project": self.get_project(ds_name, repo)}
+
+    def get_fields_raw_identities(self):
+        return ["data.activity.Who", "data.long_desc.who",
+                "data.assigned_to", "data.reporter", "data.qa_contact"]
 
     def get_identities(self, item):
         ''' Return the identities from an item '''
@@ -164,14 +158,14 @@ class BugzillaEnrich(Enrich):
                                                     item['qa_contact']}))
         return identities
 
-    def enrich_issue(self, item):
+    def get_rich_item(self, item):
 
         def get_bugzilla_url():
             u = urlparse(self.perceval_backend.url)
             return u.scheme+"//"+u.netloc
 
         if 'bug_id' not in item['data']:
-            logging.warning("Dropped bug without bug_id %s" % (issue))
+            logging.warning("Dropped bug without bug_id %s" % (item))
             return None
 
         eitem = {}
@@ -206,9 +200,9 @@ class BugzillaEnrich(Enrich):
         eitem["product"]  = issue['product'][0]['__text__']
 
         # Fix dates
-        date_ts = parser.parse(issue['creation_ts'][0]['__text__'])
+        date_ts = parse_date(issue['creation_ts'][0]['__text__'])
         eitem['creation_ts'] = date_ts.strftime('%Y-%m-%dT%H:%M:%S')
-        date_ts = parser.parse(issue['delta_ts'][0]['__text__'])
+        date_ts = parse_date(issue['delta_ts'][0]['__text__'])
         eitem['changeddate_date'] = date_ts.isoformat()
         eitem['delta_ts'] = date_ts.strftime('%Y-%m-%dT%H:%M:%S')
 
@@ -232,74 +226,6 @@ class BugzillaEnrich(Enrich):
         return eitem
 
 
-    def enrich_items(self, items):
-#         if self.perceval_backend.detail == "list":
-#             self.issues_list_to_es(items)
-#         else:
-#             self.issues_to_es(items)
-        self.issues_to_es(items)
-
-    def issues_list_to_es(self, items):
-
-        elastic_type = "issues_list"
-
-        max_items = self.elastic.max_items_bulk
-        current = 0
-        total = 0
-        bulk_json = ""
-
-        url = self.elastic.index_url+'/' + elastic_type + '/_bulk'
-
-        logging.debug("Adding items to %s (in %i packs)" % (url, max_items))
-
-        # In this client, we will publish all data in Elastic Search
-        for issue in items:
-            if current >= max_items:
-                task_init = time()
-                requests.put(url, data=bulk_json)
-                bulk_json = ""
-                total += current
-                current = 0
-                logging.debug("bulk packet sent (%.2f sec, %i total)"
-                              % (time()-task_init, total))
-            data_json = json.dumps(issue)
-            bulk_json += '{"index" : {"_id" : "%s" } }\n' % (rich_item[self.get_field_unique_id()])
-            bulk_json += data_json +"\n"  # Bulk document
-            current += 1
-        task_init = time()
-        total += current
-        requests.put(url, data=bulk_json)
-        logging.debug("bulk packet sent (%.2f sec, %i total)"
-                      % (time()-task_init, total))
-
-
-    def issues_to_es(self, items):
-
-        elastic_type = "issues"
-
-        max_items = self.elastic.max_items_bulk
-        current = 0
-        bulk_json = ""
-
-        url = self.elastic.index_url+'/' + elastic_type + '/_bulk'
-
-        logging.debug("Adding items to %s (in %i packs)" % (url, max_items))
-
-        for issue in items:
-            if current >= max_items:
-                requests.put(url, data=bulk_json)
-                bulk_json = ""
-                current = 0
-            eitem = self.enrich_issue(issue)
-            if not eitem:
-                continue
-            data_json = json.dumps(eitem)
-            bulk_json += '{"index" : {"_id" : "%s" } }\n' % (eitem[self.get_field_unique_id()])
-            bulk_json += data_json +"\n"  # Bulk document
-            current += 1
-        requests.put(url, data=bulk_json)
-
-        logging.debug("Adding issues to ES Done")
 
 
     def get_elastic_mappings(self):
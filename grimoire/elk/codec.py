@@ -0,0 +1,81 @@
+#!/usr/bin/python3
+# -*- coding: utf-8 -*-
+#
+# JSON codec for Elastic Search documents
+#
+# Copyright (C) 2015 Bitergia
+#
+# This program is free software; you can redistribute it and/or modify
+# it under the terms of the GNU General Public License as published by
+# the Free Software Foundation; either version 3 of the License, or
+# (at your option) any later version.
+#
+# This program is distributed in the hope that it will be useful,
+# but WITHOUT ANY WARRANTY; without even the implied warranty of
+# MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE. See the
+# GNU General Public License for more details.
+#
+# You should have received a copy of the GNU General Public License
+# along with this program; if not, write to the Free Software
+# Foundation, Inc., 59 Temple Place - Suite 330, Boston, MA 02111-1307, USA.
+#
+# Authors:
+#   Alvaro del Castillo San Felix <acs@bitergia.com>
+#
+
+""" JSON encoding to UTF-8 bytes and decoding of ES documents
+
+    orjson or ujson are used if installed, stdlib json if not. Objects the
+    fast backend can't encode (big ints, non str keys) use stdlib json.
+"""
+
+import json
+
+try:
+    import orjson
+except ImportError:
+    orjson = None
+
+try:
+    import ujson
+except ImportError:
+    ujson = None
+
+
+def _std_dumps(obj):
+    return json.dumps(obj, separators=(',', ':')).encode('utf-8')
+
+def _std_loads(data):
+    if isinstance(data, bytes):
+        data = data.decode('utf-8')
+    return json.loads(data)
+
+
+if orjson:
+    name = "orjson"
+
+    def dumps(obj):
+        """ Encode obj as JSON in UTF-8 bytes """
+        try:
+            return orjson.dumps(obj)
+        except TypeError:
+            return _std_dumps(obj)
+
+    loads = orjson.loads
+
+elif ujson:
+    name = "ujson"
+
+    def dumps(obj):
+        """ Encode obj as JSON in UTF-8 bytes """
+        try:
+            return ujson.dumps(obj).encode('utf-8')
+        except (TypeError, OverflowError):
+            return _std_dumps(obj)
+
+    loads = ujson.loads
+
+else:
+    name = "json"
+    dumps = _std_dumps
+    loads = _std_loads
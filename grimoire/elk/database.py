@@ -23,12 +23,81 @@
 #   Alvaro del Castillo San Felix <acs@bitergia.com>
 #
 
+from contextlib import contextmanager
 import logging
+import os
+from queue import Empty, LifoQueue
+from threading import BoundedSemaphore, Lock
+
 import MySQLdb
+import MySQLdb.cursors
+
+
+class DatabasePool(object):
+    """ Connections to a database shared by all the threads of a process
+
+        Connections are reused after each query. At most max_size are
+        used at the same time: other threads wait for a free one.
+    """
+
+    max_size = 10  # max connections to a database
+    pools = {}  # connection params -> DatabasePool
+    pools_lock = Lock()
+
+    def __init__(self, connect, max_size=None):
+        self.connect = connect  # function to create a new connection
+        self.pid = os.getpid()
+        self.idle = LifoQueue()
+        self.used = BoundedSemaphore(max_size or self.max_size)
+
+    @classmethod
+    def get_pool(cls, key, connect):
+        """ Pool of the process for the connections with params key """
+
+        with cls.pools_lock:
+            pool = cls.pools.get(key)
+            if pool is None or pool.pid != os.getpid():
+                # Connections can't be shared with forked processes
+                pool = cls(connect)
+                cls.pools[key] = pool
+            return pool
+
+    def _get_connection(self):
+        try:
+            conn = self.idle.get_nowait()
+        except Empty:
+            return self.connect()
+        try:
+            conn.ping()
+        except MySQLdb.Error:
+            logging.debug("Database connection lost. Reconnecting.")
+            conn = self.connect()
+        return conn
+
+    @contextmanager
+    def connection(self):
+        """ Connection from the pool, returned to it when done """
+
+        self.used.acquire()
+        try:
+            conn = self._get_connection()
+            try:
+                yield conn
+            except BaseException:
+                # The connection state is unknown (pending results)
+                conn.close()
+                raise
+            self.idle.put(conn)
+        finally:
+            self.used.release()
+
 
 # https://github.com/jgbarah/Grimoire-demo/blob/master/grimoire-ng-data.py#L338
 class Database:
     """To work with a database (likely including several schemas).
+
+    Connections are taken from a pool shared in the process, so a
+    Database can be used from several threads.
     """
 
     def __init__ (self, user, passwd, host, port, scrdb, shdb, prjdb):
@@ -39,7 +108,8 @@ class Database:
         self.scrdb = scrdb
         self.shdb = shdb
         self.prjdb = prjdb
-        self.db, self.cursor = self._connect()
+        self.pool = DatabasePool.get_pool((user, passwd, host, port, shdb),
+                                          self._connect)
 
     def _connect(self):
         """Connect to the MySQL database.
@@ -50,23 +120,41 @@ class Database:
                                  host = self.host, port = self.port,
                                  db = self.shdb,
                                  use_unicode = True)
-            return db, db.cursor()
+            return db
         except:
             logging.error("Database connection error")
             raise
 
-    def execute(self, query):
+    def execute(self, query, params=None):
         """Execute an SQL query with the corresponding database.
-        The query can be "templated" with {scm_db} and {sh_db}.
+        The query can include %s placeholders for the values in params.
         """
 
-        # sql = query.format(scm_db = self.scmdb,
-        #                   sh_db = self.shdb,
-        #                   prj_db = self.prjdb)
+        with self.pool.connection() as db:
+            cursor = db.cursor()
+            results = int (cursor.execute(query, params))
+            if results > 0:
+                result1 = cursor.fetchall()
+            else:
+                result1 = []
+            cursor.close()
+            db.commit()
+        return result1
+
+    def iterate(self, query, params=None, size=1000):
+        """Rows of an SQL query read from the server in packs of size.
+        A server side cursor is used so the results are not all in memory.
+        """
 
-        results = int (self.cursor.execute(query))
-        if results > 0:
-            result1 = self.cursor.fetchall()
-            return result1
-        else:
-            return []
+        with self.pool.connection() as db:
+            cursor = db.cursor(MySQLdb.cursors.SSCursor)
+            try:
+                cursor.execute(query, params)
+                while True:
+                    rows = cursor.fetchmany(size)
+                    if not rows:
+                        break
+                    for row in rows:
+                        yield row
+            finally:
+                cursor.close()
@@ -0,0 +1,109 @@
+#!/usr/bin/python3
+# -*- coding: utf-8 -*-
+#
+# Fast parsing of the dates found in the items
+#
+# Copyright (C) 2015 Bitergia
+#
+# This program is free software; you can redistribute it and/or modify
+# it under the terms of the GNU General Public License as published by
+# the Free Software Foundation; either version 3 of the License, or
+# (at your option) any later version.
+#
+# This program is distributed in the hope that it will be useful,
+# but WITHOUT ANY WARRANTY; without even the implied warranty of
+# MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE. See the
+# GNU General Public License for more details.
+#
+# You should have received a copy of the GNU General Public License
+# along with this program; if not, write to the Free Software
+# Foundation, Inc., 59 Temple Place - Suite 330, Boston, MA 02111-1307, USA.
+#
+# Authors:
+#   Alvaro del Castillo San Felix <acs@bitergia.com>
+#
+
+""" Date parsing with fast paths for the formats of the data sources
+
+    ISO 8601 (GitHub, Jira, ES and ocean metadata), Bugzilla
+    "YYYY-MM-DD HH:MM:SS [+HHMM]", git "Tue Aug 14 14:30:13 2012 -0300"
+    and RFC 2822 (mbox) dates are parsed with regular expressions. Other
+    formats use dateutil. The results for the last dates are cached.
+"""
+
+from datetime import datetime, timedelta, timezone
+from functools import lru_cache
+import re
+
+from dateutil import parser
+
+CACHE_SIZE = 10000  # dates remembered by parse_date
+
+MONTHS = {"Jan": 1, "Feb": 2, "Mar": 3, "Apr": 4, "May": 5, "Jun": 6,
+          "Jul": 7, "Aug": 8, "Sep": 9, "Oct": 10, "Nov": 11, "Dec": 12}
+
+# ISO 8601 and Bugzilla: 2016-01-20T09:29:03.123Z, 2013-06-25 11:55:46 +0200
+ISO_RE = re.compile(r"^(\d{4})-(\d{2})-(\d{2})"
+                    r"(?:[T ](\d{2}):(\d{2})(?::(\d{2})(?:\.(\d{1,6})\d*)?)?)?"
+                    r" ?(Z|[+-]\d{2}:?\d{2})?$")
+# git: Tue Aug 14 14:30:13 2012 -0300
+GIT_RE = re.compile(r"^\w{3} (\w{3}) +(\d{1,2}) (\d{2}):(\d{2}):(\d{2}) "
+                    r"(\d{4}) ([+-]\d{4})$")
+# RFC 2822: Tue, 1 Jul 2003 10:52:37 +0200 (CEST)
+RFC_RE = re.compile(r"^(?:\w{3}, *)?(\d{1,2}) (\w{3}) (\d{4}) "
+                    r"(\d{2}):(\d{2})(?::(\d{2}))? ([+-]\d{4})(?: \(.*\))?$")
+
+
+def _get_tz(offset):
+    """ tzinfo for an offset like Z, +0200 or -03:00 """
+
+    if offset is None:
+        return None
+    if offset == "Z":
+        return timezone.utc
+    offset = offset.replace(":", "")
+    minutes = int(offset[1:3]) * 60 + int(offset[3:5])
+    if offset[0] == "-":
+        minutes = -minutes
+    return timezone(timedelta(minutes=minutes))
+
+def _parse_fast(date):
+    """ datetime for date in a known format, None for other formats """
+
+    m = ISO_RE.match(date)
+    if m:
+        (year, month, day, hour, minute, second, micro, offset) = m.groups()
+        if micro:
+            micro = int(micro.ljust(6, "0"))
+        return datetime(int(year), int(month), int(day), int(hour or 0),
+                        int(minute or 0), int(second or 0), micro or 0,
+                        _get_tz(offset))
+
+    m = GIT_RE.match(date)
+    if m:
+        (month, day, hour, minute, second, year, offset) = m.groups()
+        return datetime(int(year), MONTHS[month], int(day), int(hour),
+                        int(minute), int(second), 0, _get_tz(offset))
+
+    m = RFC_RE.match(date)
+    if m:
+        (day, month, year, hour, minute, second, offset) = m.groups()
+        return datetime(int(year), MONTHS[month], int(day), int(hour),
+                        int(minute), int(second or 0), 0, _get_tz(offset))
+
+    return None
+
+@lru_cache(maxsize=CACHE_SIZE)
+def parse_date(date):
+    """ Parse a date string to datetime, like dateutil parser.parse """
+
+    if isinstance(date, str):
+        try:
+            dt = _parse_fast(date)
+        except (KeyError, ValueError):
+            # Bad month name or values out of range
+            dt = None
+        if dt is not None:
+            return dt
+
+    return parser.parse(date)
@@ -23,13 +23,21 @@
 #   Alvaro del Castillo San Felix <acs@bitergia.com>
 #
 
+from concurrent.futures import ThreadPoolExecutor
+from functools import partial
 from datetime import datetime
-from dateutil import parser
+import gzip
 import json
 import logging
+import os
 import requests
+from requests.adapters import HTTPAdapter
+from threading import BoundedSemaphore, Lock
 from time import time, sleep
 
+from grimoire.elk import codec
+from grimoire.elk.dates import parse_date
+
 class ElasticConnectException(Exception):
     message = "Can't connect to ElasticSearch"
 
@@ -37,13 +45,115 @@ class ElasticWriteException(Exception):
     message = "Can't write to ElasticSearch"
 
 
+class LastDates(dict):
+    """ Last date for each origin, from ElasticSearch.get_last_dates
+
+        If truncated, not all the origins were read: the ones not found
+        could have items in the index.
+    """
+
+    truncated = False
+
+    def is_known(self, origin):
+        """ The last date for origin is in the dates read """
+        return origin in self or not self.truncated
+
+
+class ElasticSession(requests.Session):
+    """ HTTP session with pooled keep-alive connections to ElasticSearch """
+
+    def __init__(self, pool_connections, pool_maxsize, max_retries,
+                 timeout=None, compress=False):
+        super().__init__()
+        self.timeout = timeout  # default timeout for all the requests
+        self.compress = compress  # gzip the request bodies
+        adapter = HTTPAdapter(pool_connections=pool_connections,
+                              pool_maxsize=pool_maxsize,
+                              max_retries=max_retries)
+        self.mount('http://', adapter)
+        self.mount('https://', adapter)
+
+    def request(self, method, url, **kwargs):
+        if 'timeout' not in kwargs:
+            kwargs['timeout'] = self.timeout
+        data = kwargs.get('data')
+        if self.compress and data:
+            if isinstance(data, str):
+                data = data.encode('utf-8')
+            kwargs['data'] = gzip.compress(data)
+            headers = kwargs.get('headers') or {}
+            headers['Content-Encoding'] = 'gzip'
+            kwargs['headers'] = headers
+        return super().request(method, url, **kwargs)
+
+
 class ElasticSearch(object):
 
+    # HTTP session shared by all ElasticSearch instances in the process
+    session = None
+    session_pid = None  # process owning the session (RQ workers fork)
+    session_lock = Lock()
+
+    # Shared HTTP session config
+    pool_connections = 10  # number of ES hosts with pooled connections
+    pool_maxsize = 10  # max keep-alive connections per ES host
+    max_retries = 3  # retries for failed connections (not for requests)
+    timeout = (10, 300)  # (connect, read) timeout in seconds
+    compress = False  # gzip request bodies (http.compression in ES)
+
+    # Threads sending bulk packets in parallel (0: send them synchronously)
+    bulk_workers = 0
+    max_inflight_bulk = None  # max packets queued or sent (2*bulk_workers)
+    # refresh param for bulk requests: None (don't wait), "wait_for"
+    # (until the items are visible, ES >= 5) or "true" (force a refresh)
+    refresh_bulk = None
+
+    # Last dates for all the origins in an index, cached in an update cycle
+    last_dates_cache = None  # (index url, field, group field) -> dates
+    last_dates_max_groups = 10000  # max origins read in the aggregation
+
     @classmethod
     def safe_index(cls, unique_id):
         """ Return a valid elastic index generated from unique_id """
         return unique_id.replace("/","_").lower()
 
+    @classmethod
+    def cache_last_dates(cls, enable=True):
+        """ Start a new cache of last dates (once per update cycle) """
+        cls.last_dates_cache = {} if enable else None
+
+    @classmethod
+    def configure_session(cls, pool_maxsize=None, timeout=None,
+                          compress=None, max_retries=None):
+        """ Change the shared HTTP session config. A new session is created """
+
+        with cls.session_lock:
+            if pool_maxsize is not None:
+                cls.pool_maxsize = pool_maxsize
+            if timeout is not None:
+                cls.timeout = timeout
+            if compress is not None:
+                cls.compress = compress
+            if max_retries is not None:
+                cls.max_retries = max_retries
+            if cls.session:
+                cls.session.close()
+            cls.session = None
+
+    @classmethod
+    def get_session(cls):
+        """ Return the HTTP session shared by all the ES connections """
+
+        with cls.session_lock:
+            # Connections can not be shared with a forked process
+            if cls.session is None or cls.session_pid != os.getpid():
+                cls.session = ElasticSession(cls.pool_connections,
+                                             cls.pool_maxsize,
+                                             cls.max_retries,
+                                             cls.timeout, cls.compress)
+                cls.session_pid = os.getpid()
+            return cls.session
+
     def __init__(self, url, index, mappings = None, clean = False):
         ''' clean: remove already existing index '''
 
@@ -51,17 +161,22 @@ class ElasticSearch(object):
         # Valid index for elastic
         self.index = self.safe_index(index)
         self.index_url = self.url+"/"+self.index
-        self.max_items_bulk = 100
-        self.wait_bulk_seconds = 2  # time to wait to complete a bulk operation
+        self.max_items_bulk = 1000  # max items in a bulk packet
+        self.max_bytes_bulk = 10 * 1024 * 1024  # max bytes in a bulk packet
+        self.max_seconds_bulk = 30  # max seconds items wait to be sent
+        self.max_retries_bulk = 5  # retries for items rejected in a bulk
+        self.retry_wait_bulk = 1  # first wait before a retry, then doubled
+        # Use self.requests for all HTTP requests to ES
+        self.requests = self.get_session()
 
         try:
-            r = requests.get(self.index_url)
+            r = self.requests.get(self.index_url)
         except requests.exceptions.ConnectionError:
             raise ElasticConnectException()
 
         if r.status_code != 200:
             # Index does no exists
-            r = requests.post(self.index_url)
+            r = self.requests.post(self.index_url)
             if r.status_code != 200:
                 logging.info("Can't create index %s (%s)" %
                              (self.index_url, r.status_code))
@@ -70,93 +185,107 @@ class ElasticSearch(object):
                 logging.info("Created index " + self.index_url)
         else:
             if clean:
-                requests.delete(self.index_url)
-                requests.post(self.index_url)
+                self.requests.delete(self.index_url)
+                self.requests.post(self.index_url)
                 logging.info("Deleted and created index " + self.index_url)
         if mappings:
             self.create_mappings(mappings)
 
 
     def _safe_put_bulk(self, url, bulk_json):
-        """ Bulk PUT controlling unicode issues """
+        """ Bulk PUT of the NDJSON bytes encoded by the codec
 
-        try:
-            requests.put(url, data=bulk_json)
-        except UnicodeEncodeError:
-            # Related to body.encode('iso-8859-1'). mbox data
-            logging.error("Encondig error ... converting bulk to iso-8859-1")
-            bulk_json = bulk_json.encode('iso-8859-1','ignore')
-            requests.put(url, data=bulk_json)
+            The items are already UTF-8 bytes, so requests doesn't encode
+            the body (as iso-8859-1 for str, failing with mbox data).
+        """
+
+        headers = {"Content-Type": "application/x-ndjson"}
+
+        return self.requests.put(url, data=bulk_json, headers=headers)
 
     def bulk_upload(self, items, field_id):
         ''' Upload in controlled packs items to ES using bulk API '''
 
-        max_items = self.max_items_bulk
-        current = 0
-        new_items = 0  # total items added with bulk
-        bulk_json = ""
-
-        url = self.index_url+'/items/_bulk'
+        bulk = BulkWriter(self)
 
-        logging.debug("Adding items to %s (in %i packs)" % (url, max_items))
+        logging.debug("Adding items to %s (in %i packs)" % (bulk.url,
+                                                            bulk.max_items))
 
         for item in items:
-            if current >= max_items:
-                task_init = time()
-                self._safe_put_bulk(url, bulk_json)
-                bulk_json = ""
-                new_items += current
-                current = 0
-                logging.debug("bulk packet sent (%.2f sec, %i total)"
-                              % (time()-task_init, new_items))
-            data_json = json.dumps(item)
-            bulk_json += '{"index" : {"_id" : "%s" } }\n' % (item[field_id])
-            bulk_json += data_json +"\n"  # Bulk document
-            current += 1
-        task_init = time()
-        self._safe_put_bulk(url, bulk_json)
-        new_items += current
-        logging.debug("bulk packet sent (%.2f sec prev, %i total)"
-                      % (time()-task_init, new_items))
+            bulk.add(item, item[field_id])
 
-        return new_items
+        return bulk.close()
 
     def bulk_upload_sync(self, items, field_id, sync=True):
         ''' Upload in controlled packs items to ES using bulk API
-            and wait until the items appears in searches '''
+            and make them visible in searches '''
 
-        # After a bulk upload the searches are not refreshed real time
-        # This method waits until the upload is visible in searches
+        # After a bulk upload the searches are not refreshed real time.
+        # Just one refresh after all packs instead of waiting for each one.
 
-        r = requests.get(self.index_url+'/_search?size=1')
-        total = r.json()['hits']['total']  # Already existing items
         new_items = self.bulk_upload(items, field_id)
-        if not sync:
-            return
-        total += new_items
+        if sync:
+            self.refresh()
+
+        return new_items
+
+    def refresh(self):
+        ''' Make all the operations in the index visible in searches '''
+
+        r = self.requests.post(self.index_url+'/_refresh')
+        if r.status_code != 200:
+            logging.warning("Can't refresh %s (%i)" % (self.index_url,
+                                                       r.status_code))
 
-        # Wait until in searches all items are returned
-        # In incremental update, some items are updates not additions so
-        # this check will fail. Exist ok in the timeout for this case.
+    def scroll(self, query, size=1000, scroll="10m"):
+        """ Hits for the search query, reading all the pages with a scroll """
 
-        total_search = 0  # total items found with search
-        search_start = datetime.now()
-        while total_search != total:
-            sleep(0.1)
-            r = requests.get(self.index_url+'/_search?size=1')
-            total_search = r.json()['hits']['total']
-            if (datetime.now()-search_start).total_seconds() > self.wait_bulk_seconds:
-                logging.debug("Bulk data does not appear as NEW after %is" % (self.wait_bulk_seconds))
-                logging.debug("Probably %i item updates" % (total-total_search))
-                break
+        url = self.index_url + "/_search?scroll=%s&size=%i" % (scroll, size)
+        r = self.requests.post(url, data=query)
 
+        scroll_id = None
+        try:
+            while True:
+                rjson = codec.loads(r.content)
+                scroll_id = rjson.get("_scroll_id")
+                if "hits" not in rjson:
+                    logging.warning("No results found from %s" % (url))
+                    break
+                hits = rjson["hits"]["hits"]
+                if not hits:
+                    break
+                for hit in hits:
+                    yield hit
+                if not scroll_id:
+                    break
+                url = self.url + "/_search/scroll"
+                scroll_data = {"scroll": scroll, "scroll_id": scroll_id}
+                r = self.requests.post(url, data=json.dumps(scroll_data))
+        finally:
+            if scroll_id:
+                # Free the scroll context in ES
+                url = self.url + "/_search/scroll"
+                self.requests.delete(url, data=json.dumps({"scroll_id": [scroll_id]}))
+
+    def mget(self, ids):
+        """ Documents found in the index for ids """
+
+        if not ids:
+            return []
+
+        url = self.index_url + "/_mget"
+        query = {"docs": [{"_id": _id} for _id in ids]}
+        r = self.requests.post(url, data=codec.dumps(query))
+
+        return [doc["_source"] for doc in codec.loads(r.content)['docs']
+                if doc.get('found')]
 
     def create_mappings(self, mappings):
 
         for _type in mappings:
             # First create the manual mappings
             url_map = self.index_url + "/"+_type+"/_mapping"
-            r = requests.put(url_map, data=mappings[_type])
+            r = self.requests.put(url_map, data=mappings[_type])
 
             if r.status_code != 200:
                 logging.error("Error creating ES mappings %s" % (r.text))
@@ -176,7 +305,7 @@ class ElasticSearch(object):
                 }
               ]
             } """
-            r = requests.put(url_map, data=not_analyze_strings)
+            r = self.requests.put(url_map, data=not_analyze_strings)
 
             # Disable dynamic mapping for raw data
             disable_dynamic = """ {
@@ -189,10 +318,83 @@ class ElasticSearch(object):
                     }
                 }
             } """
-            r = requests.put(url_map, data=disable_dynamic)
+            r = self.requests.put(url_map, data=disable_dynamic)
+
+
+
+
+    @classmethod
+    def _get_agg_date(cls, agg):
+        """ datetime for the value of a max aggregation """
+
+        last_date = None
+        if "value_as_string" in agg:
+            last_date = parse_date(agg["value_as_string"])
+        elif agg["value"]:
+            last_date = datetime.fromtimestamp(agg["value"])
+        return last_date
+
+    def get_last_dates(self, field, group_field="origin"):
+        ''' Last date in field for each value of group_field (origins)
+
+            All the dates are read in a single terms aggregation (up to
+            last_dates_max_groups values). With cache_last_dates() they are
+            read once for each index.
+        '''
+
+        key = (self.index_url, field, group_field)
+        cache = self.last_dates_cache
+        if cache is not None and key in cache:
+            return cache[key]
+
+        query = {
+            "size": 0,
+            "aggs": {
+                "groups": {
+                    "terms": {
+                        "field": group_field,
+                        "size": self.last_dates_max_groups
+                    },
+                    "aggs": {
+                        "1": {
+                            "max": {
+                                "field": field
+                            }
+                        }
+                    }
+                }
+            }
+        }
 
+        url = self.index_url + "/_search"
+        logging.debug("%s %s" % (url, json.dumps(query)))
+        res_json = self.requests.post(url, data=json.dumps(query)).json()
 
+        last_dates = LastDates()
+        if 'aggregations' in res_json:
+            groups = res_json["aggregations"]["groups"]
+            for bucket in groups["buckets"]:
+                last_dates[bucket["key"]] = self._get_agg_date(bucket["1"])
+            if groups.get("sum_other_doc_count", 0) > 0:
+                logging.warning("More than %i %s values in %s: the last dates "
+                                "of the rest are read one by one" %
+                                (self.last_dates_max_groups, group_field,
+                                 self.index_url))
+                last_dates.truncated = True
+
+        if cache is not None:
+            cache[key] = last_dates
+        return last_dates
+
+    def count(self, _filter=None):
+        ''' Number of items in the index (with _filter term if given) '''
+
+        query = {}
+        if _filter:
+            query = {"query": {"term": {_filter['name']: _filter['value']}}}
 
+        r = self.requests.post(self.index_url + "/_count", data=json.dumps(query))
+        return r.json().get("count", 0)
 
     def get_last_date(self, field, _filter = None):
         '''
@@ -200,6 +402,14 @@ class ElasticSearch(object):
             :_filter: additional filter to find the date
         '''
 
+        if _filter and self.last_dates_cache is not None:
+            # The dates for all the values are read just once in the cycle
+            last_dates = self.get_last_dates(field, _filter['name'])
+            if last_dates.is_known(_filter['value']):
+                return last_dates.get(_filter['value'])
+            logging.debug("Last date for %s not read with all the values" %
+                          (_filter['value']))
+
         last_date = None
 
         url = self.index_url
@@ -230,16 +440,306 @@ class ElasticSearch(object):
         } ''' % (data_query, data_agg)
 
         logging.debug("%s %s" % (url, data_json))
-        res = requests.post(url, data=data_json)
+        res = self.requests.post(url, data=data_json)
         res_json = res.json()
 
         if 'aggregations' in res_json:
-            if "value_as_string" in res_json["aggregations"]["1"]:
-                last_date = res_json["aggregations"]["1"]["value_as_string"]
-                last_date = parser.parse(last_date)
-            else:
-                last_date = res_json["aggregations"]["1"]["value"]
-                if last_date:
-                    last_date = datetime.fromtimestamp(last_date)
+            last_date = self._get_agg_date(res_json["aggregations"]["1"])
 
         return last_date
+
+
+class BulkWriter(object):
+    """ Buffer of encoded bulk actions sent to ES in packets
+
+        A packet is sent when it reaches the max number of items, the max
+        size in bytes or when its first item has waited the max seconds,
+        whatever comes first.
+
+        The items rejected by ES because of load (429, 503) and the packets
+        that could not be delivered are sent again, with exponential
+        backoff, up to max_retries_bulk times. Other item errors (mappings,
+        parsing) are permanent and only reported.
+
+        With workers, packets are sent from a thread pool while the caller
+        goes on adding items. Once max_inflight packets are pending, adding
+        items blocks until one is sent. With ordered, packets are sent one
+        by one in the order they were created.
+
+        With commit, add_mark() can be called after adding items: commit is
+        called with the last mark once all the packets with the items added
+        before it have been sent, in the order of the marks. After a packet
+        with undelivered items (rejected packet, retries exhausted), no more
+        marks are committed. Items with permanent errors don't block them:
+        sending them again would fail the same way.
+    """
+
+    retry_status = [429, 503]  # ES too busy: try again later
+    max_retry_wait = 60  # max seconds between retries
+
+    def __init__(self, elastic, _type="items", url=None, max_items=None,
+                 max_bytes=None, max_seconds=None, workers=None,
+                 ordered=False, commit=None):
+        self.elastic = elastic
+        self.url = url
+        if not self.url:
+            self.url = elastic.index_url + '/' + _type + '/_bulk'
+        if elastic.refresh_bulk:
+            self.url += "?refresh=" + elastic.refresh_bulk
+        self.max_items = max_items or elastic.max_items_bulk
+        self.max_bytes = max_bytes or elastic.max_bytes_bulk
+        self.max_seconds = max_seconds or elastic.max_seconds_bulk
+        self.max_retries = elastic.max_retries_bulk
+        self.retry_wait = elastic.retry_wait_bulk
+
+        self.chunks = []  # encoded NDJSON chunks (one per item) in the packet
+        self.size = 0  # bytes in the current packet
+        self.packet_start = None  # time the first item was added
+        self.total = 0  # total items indexed
+        # Items indexed, sent again and failed in all packets. Undelivered
+        # items are the failed ones which could be indexed sending them again
+        self.stats = {"ok": 0, "retried": 0, "failed": 0, "undelivered": 0}
+
+        self.executor = None
+        if workers is None:
+            workers = elastic.bulk_workers
+        if workers > 0:
+            if ordered:
+                workers = 1
+            max_inflight = elastic.max_inflight_bulk or 2 * workers
+            self.executor = ThreadPoolExecutor(max_workers=workers)
+            self.inflight = BoundedSemaphore(max_inflight)
+        self.lock = Lock()  # stats are updated from the workers
+        self.errors = []  # exceptions raised sending packets
+
+        self.commit = commit
+        self.mark = None  # last mark for the items in the packet
+        self.packets = 0  # packets created
+        self.packets_marks = {}  # packet number -> mark, until committed
+        self.packets_done = set()  # packets sent, waiting for previous ones
+        self.next_commit = 0  # first packet not committed
+        self.commit_limit = None  # first packet with items not indexed
+        self.commit_lock = Lock()
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, exc_type, exc_value, traceback):
+        self.close()
+
+    @classmethod
+    def encode_item(cls, item, item_id):
+        """ Encode an item as a bulk index action in NDJSON """
+
+        action = codec.dumps({"index": {"_id": item_id}})
+
+        return action + b"\n" + codec.dumps(item) + b"\n"
+
+    def add(self, item, item_id):
+        """ Add an item to be indexed with item_id """
+
+        self.add_chunk(self.encode_item(item, item_id))
+
+    def add_mark(self, mark):
+        """ Mark to be committed once the items already added are sent """
+        self.mark = mark
+
+    def _new_packet(self):
+        """ Number for a new packet, with the last mark for its items """
+
+        packet = self.packets
+        self.packets += 1
+        if self.commit:
+            self.packets_marks[packet] = self.mark
+            self.mark = None
+        return packet
+
+    def _packet_committed(self, packet, failed=False):
+        """ Commit the last mark of the packets indexed in order """
+
+        if not self.commit:
+            return
+
+        with self.commit_lock:
+            if failed:
+                # The marks can't go beyond the items not indexed
+                if self.commit_limit is None or packet < self.commit_limit:
+                    self.commit_limit = packet
+            self.packets_done.add(packet)
+            mark = None
+            while self.next_commit in self.packets_done and \
+                (self.commit_limit is None or self.next_commit < self.commit_limit):
+                self.packets_done.remove(self.next_commit)
+                packet_mark = self.packets_marks.pop(self.next_commit)
+                if packet_mark is not None:
+                    mark = packet_mark
+                self.next_commit += 1
+            if mark is not None:
+                self.commit(mark)
+
+    def add_chunk(self, chunk):
+        """ Add an already encoded NDJSON chunk (action and item) """
+
+        if self.chunks and self.size + len(chunk) > self.max_bytes:
+            # Don't go beyond the max packet size
+            self.flush()
+
+        if self.packet_start is None:
+            self.packet_start = time()
+        self.chunks.append(chunk)
+        self.size += len(chunk)
+
+        if len(self.chunks) >= self.max_items or self.size >= self.max_bytes or \
+            time() - self.packet_start >= self.max_seconds:
+            self.flush()
+
+    def _put_bulk(self, chunks):
+        """ Send chunks to ES and return the items failed, the chunks to be
+            sent again and whether the whole packet was rejected """
+
+        failed = 0
+        retry = []
+
+        try:
+            r = self.elastic._safe_put_bulk(self.url, b"".join(chunks))
+        except requests.exceptions.RequestException as ex:
+            logging.warning("Can't send bulk packet to %s: %s" % (self.url, ex))
+            return 0, chunks, False
+
+        if r.status_code in self.retry_status:
+            return 0, chunks, False
+        elif r.status_code != 200:
+            logging.error("Bulk packet rejected by %s (%i): %s" %
+                          (self.url, r.status_code, r.text[:500]))
+            return len(chunks), [], True
+
+        res = codec.loads(r.content)
+        if not res.get('errors'):
+            return 0, [], False
+
+        for chunk, res_item in zip(chunks, res['items']):
+            # {"index": {"_id": ..., "status": ..., "error": ...}}
+            result = list(res_item.values())[0]
+            if result['status'] < 300:
+                continue
+            if result['status'] in self.retry_status:
+                retry.append(chunk)
+            else:
+                failed += 1
+                logging.error("Can't index %s in %s (%i): %s" %
+                              (result.get('_id'), self.url, result['status'],
+                               result.get('error')))
+
+        return failed, retry, False
+
+    def _send_packet(self, chunks, size):
+        """ Send a packet, retrying the rejected items, and get its stats """
+
+        stats = {"ok": 0, "retried": 0, "failed": 0, "undelivered": 0}
+
+        task_init = time()
+        pending = chunks
+        retries = 0
+
+        while pending:
+            failed, retry, rejected = self._put_bulk(pending)
+            stats["failed"] += failed
+            if rejected:
+                stats["undelivered"] += failed
+            stats["ok"] += len(pending) - failed - len(retry)
+            if retry and retries < self.max_retries:
+                wait = min(self.retry_wait * 2 ** retries, self.max_retry_wait)
+                logging.debug("%i items rejected in %s, retrying in %i sec" %
+                              (len(retry), self.url, wait))
+                sleep(wait)
+                retries += 1
+                stats["retried"] += len(retry)
+            elif retry:
+                logging.error("%i items not indexed in %s after %i retries" %
+                              (len(retry), self.url, retries))
+                stats["failed"] += len(retry)
+                stats["undelivered"] += len(retry)
+                retry = []
+            pending = retry
+
+        with self.lock:
+            self.total += stats["ok"]
+            for stat in stats:
+                self.stats[stat] += stats[stat]
+            total = self.total
+
+        msg = "bulk packet sent (%.2f sec, %i bytes, %i ok, %i retried, " + \
+              "%i failed, %i total)"
+        msg = msg % (time()-task_init, size, stats["ok"],
+                     stats["retried"], stats["failed"], total)
+        if stats["failed"] > 0:
+            logging.warning(msg)
+        else:
+            logging.debug(msg)
+
+        return stats
+
+    def _packet_done(self, packet, future):
+        """ Release the packet slot and collect the worker errors """
+
+        self.inflight.release()
+        ex = future.exception()
+        if ex:
+            logging.error("Error sending bulk packet to %s: %s" % (self.url, ex))
+            with self.lock:
+                self.errors.append(ex)
+            self._packet_committed(packet, failed=True)
+        else:
+            self._packet_committed(packet,
+                                   future.result()["undelivered"] > 0)
+
+    def flush(self):
+        """ Send the current packet to ES and return its stats
+
+            With workers the packet is queued and None is returned.
+        """
+
+        if not self.chunks:
+            if self.mark is not None:
+                # The items for the mark are already in previous packets
+                self._packet_committed(self._new_packet())
+            return
+
+        chunks = self.chunks
+        size = self.size
+        self.chunks = []
+        self.size = 0
+        self.packet_start = None
+        packet = self._new_packet()
+
+        if not self.executor:
+            try:
+                stats = self._send_packet(chunks, size)
+            except Exception:
+                self._packet_committed(packet, failed=True)
+                raise
+            self._packet_committed(packet, stats["undelivered"] > 0)
+            return stats
+
+        self.inflight.acquire()  # wait for a free slot (backpressure)
+        future = self.executor.submit(self._send_packet, chunks, size)
+        future.add_done_callback(partial(self._packet_done, packet))
+
+    def close(self):
+        """ Send pending items and return the total items indexed """
+
+        self.flush()
+
+        if self.executor:
+            self.executor.shutdown(wait=True)
+            self.executor = None
+
+        if self.stats["failed"] > 0:
+            logging.error("%i items could not be indexed in %s" %
+                          (self.stats["failed"], self.url))
+        if self.errors:
+            logging.error("%i bulk packets could not be sent to %s" %
+                          (len(self.errors), self.url))
+            raise ElasticWriteException()
+
+        return self.total
@@ -23,12 +23,20 @@
 #   Alvaro del Castillo San Felix <acs@bitergia.com>
 #
 
-from functools import lru_cache
 import logging
-import MySQLdb
+from time import time
 
+from grimoire.elk.elastic import BulkWriter
+from grimoire.elk.identities import EnrollmentsIndex, IdentityCache, \
+    IdentityStore, MISSING
+from grimoire.elk.projects import ProjectsIndex
+from grimoire.elk.sortinghat import SortingHat
+
+
+from sqlalchemy import func
 
 from sortinghat.db.database import Database
+from sortinghat.db.model import Enrollment, Identity, Profile, UniqueIdentity
 from sortinghat import api
 from sortinghat.exceptions import AlreadyExistsError, NotFoundError, WrappedValueError
 
@@ -36,45 +44,103 @@ logger = logging.getLogger(__name__)
 
 class Enrich(object):
 
+    type_name = "items"  # ES type for the enriched items
+
+    # Sorting Hat data shared by all the enrichers in the process
+    uuids_cache = IdentityCache("uuids")  # identity -> uuid
+    enrollments_cache = IdentityCache("enrollments")  # uuid -> enrollments
+    unique_identities_cache = IdentityCache("unique identities")
+    identities_store = None  # IdentityStore kept between runs
+
     def __init__(self, db_projects_map = None, db_sortinghat = None, ):
         self.sortinghat = False
+        self.db_sortinghat = db_sortinghat
+        self._sh_db = None  # connected the first time it is used
         if db_sortinghat:
-            self.sh_db = Database("root", "", db_sortinghat, "mariadb")
             self.sortinghat = True
+        self.sh_map = None  # identities already resolved in Sorting Hat
+        self.enrollments_index = None  # organizations of uuids over time
         self.prjs_map = None
         if  db_projects_map:
-            self.prjs_map = self._get_projects_map(db_projects_map)
+            # Loaded the first time it is used by any enricher
+            self.prjs_map = ProjectsIndex.get_index(db_projects_map)
+
+    def get_project(self, ds_name, repo):
+        """ Project for repo in the data source ds_name of the projects map """
+        return self.prjs_map.get_project(ds_name, repo)
 
-    def _get_projects_map(self, db_projects_map):
-        prjs_map = {}
+    def set_elastic(self, elastic):
+        self.elastic = elastic
+
+    @property
+    def sh_db(self):
+        if self._sh_db is None:
+            self._sh_db = Database("root", "", self.db_sortinghat, "mariadb")
+        return self._sh_db
+
+    def get_rich_item(self, item):
+        """ Return the enriched item for a raw item (None to drop it) """
+        raise NotImplementedError
 
-        db = MySQLdb.connect(user="root", passwd="", host="mariadb",
-                             db = db_projects_map)
-        cursor = db.cursor()
+    def get_rich_items(self, item):
+        """ Return the list of enriched items generated from a raw item """
 
-        query = """
-        SELECT data_source, p.id, pr.repository_name
-        FROM projects p
-        JOIN project_repositories pr ON p.project_id=pr.project_id
+        eitem = self.get_rich_item(item)
+        if eitem is None:
+            return []
+        return [eitem]
+
+    def get_new_cache(self):
+        """ Data cached while enriching since the last call (geolocations)
+
+            Enrich worker processes send it to the process uploading the
+            items, which adds it with add_new_cache.
         """
+        return None
 
-        res = int(cursor.execute(query))
-        if res > 0:
-            rows = cursor.fetchall()
-            for row in rows:
-                [ds, name, repo] = row
-                if ds not in prjs_map:
-                    prjs_map[ds] = {}
-                prjs_map[ds][repo] = name
-        else:
-            raise RuntimeException("Can't find projects mapping in %s" % (db_projects_map))
-        return prjs_map
+    def add_new_cache(self, cache):
+        """ Add the data cached by an enricher in other process """
+        pass
 
-    def set_elastic(self, elastic):
-        self.elastic = elastic
+    def enrich_items_done(self):
+        """ Called once all the enriched items are uploaded """
+        pass
 
-    def enrich_items(self, items):
-        raise NotImplementedError
+    def enrich_items(self, items, checkpoint=None):
+        """ Enrich the raw items and upload them to ES
+
+            With an EnrichCheckpoint, it is committed once the enriched items
+            are uploaded. Return the number of enriched items indexed.
+        """
+
+        commit = checkpoint.commit if checkpoint else None
+        bulk = BulkWriter(self.elastic, self.type_name, commit=commit)
+        field_id = self.get_field_unique_id()
+
+        logging.debug("Adding items to %s (in %i packs)" % (bulk.url,
+                                                            bulk.max_items))
+        task_init = time()
+        nitems = 0
+        with bulk:
+            for item in items:
+                nitems += 1
+                for eitem in self.get_rich_items(item):
+                    bulk.add(eitem, eitem[field_id])
+                if checkpoint:
+                    bulk.add_mark(checkpoint.mark(item))
+        if checkpoint and bulk.stats['undelivered'] > 0:
+            # Next calls with the checkpoint must not move it either
+            checkpoint.block()
+        self.enrich_items_done()
+
+        elapsed = time() - task_init
+        logging.debug("Enriched %i items in %.2f sec (%.1f items/s): "
+                      "%i indexed, %i retried, %i failed" %
+                      (nitems, elapsed, nitems / elapsed if elapsed else 0,
+                       bulk.stats['ok'], bulk.stats['retried'],
+                       bulk.stats['failed']))
+
+        return bulk.total
 
     def get_connector_name(self):
         """ Find the name for the current connector """
@@ -85,14 +151,22 @@ class Enrich(object):
         """ Field with the date in the JSON enriched items """
         raise NotImplementedError
 
+    def get_field_unique_id(self):
+        """ Field with the ES id of the enriched items """
+        return "ocean-unique-id"
+
     def get_fields_uuid(self):
         """ Fields with unique identities in the JSON enriched items """
-        raise NotImplementedError
+        return []
 
     def get_identities(self, item):
         """ Return the identities from an item """
         raise NotImplementedError
 
+    def get_fields_raw_identities(self):
+        """ Fields of the raw items used by get_identities (None: all) """
+        return None
+
     def get_email_domain(self, email):
         domain = None
         try:
@@ -114,6 +188,10 @@ class Enrich(object):
         # If possible, enriched_item and item will have the same id
         return eitem["_id"]
 
+    def get_fields_item_id(self):
+        """ Fields of the enriched items used by get_item_id """
+        return []
+
     def get_last_update_from_es(self, _filter=None):
 
         last_update = self.elastic.get_last_date(self.get_field_date(), _filter)
@@ -129,26 +207,219 @@ class Enrich(object):
 
 
     # Sorting Hat stuff to be moved to SortingHat class
-    @lru_cache()
+    @classmethod
+    def get_identities_caches(cls):
+        return [cls.uuids_cache, cls.enrollments_cache,
+                cls.unique_identities_cache]
+
+    @classmethod
+    def set_identities_cache_size(cls, max_size):
+        """ Max number of entries in each of the identities caches """
+        for cache in cls.get_identities_caches():
+            cache.set_max_size(max_size)
+
+    @classmethod
+    def log_identities_cache_stats(cls):
+        for cache in cls.get_identities_caches():
+            stats = cache.get_stats()
+            logging.info("Cache %s: %i/%i entries, %i hits, %i misses "
+                         "(%.1f%% hits), %i evicted, %i invalidated" %
+                         (cache.name, stats['size'], stats['max_size'],
+                          stats['hits'], stats['misses'],
+                          stats['hit_ratio'] * 100, stats['evictions'],
+                          stats['invalidations']))
+
+    @classmethod
+    def set_identities_store(cls, path):
+        """ Save the identities resolved in the sqlite file path """
+        if cls.identities_store:
+            cls.identities_store.close()
+        cls.identities_store = IdentityStore(path) if path else None
+
+    def get_sh_watermark(self):
+        """ Value which changes when Sorting Hat identities change """
+
+        with self.sh_db.connect() as session:
+            watermark = [session.query(UniqueIdentity).count(),
+                         session.query(Identity).count(),
+                         session.query(Enrollment).count()]
+            if hasattr(Identity, 'last_modified'):
+                # Available in newer Sorting Hat versions
+                last = session.query(func.max(Identity.last_modified)).scalar()
+                watermark.append(last)
+        return ":".join(str(value) for value in watermark)
+
+    def load_identities_store(self):
+        """ Check the stored identities are still valid in Sorting Hat """
+
+        if self.identities_store and self.sortinghat:
+            if self.identities_store.validate(self.db_sortinghat,
+                                              self.get_sh_watermark()):
+                logging.info("Using identities stored in %s" %
+                             self.identities_store.path)
+
+    def save_identities_store(self):
+        """ Save the identities resolved, valid for current Sorting Hat """
+
+        if self.identities_store and self.sortinghat:
+            self.identities_store.save(self.db_sortinghat,
+                                       self.get_sh_watermark())
+
+    def is_identity_stored(self, identity, backend_name):
+        """ True if identity is already registered in Sorting Hat """
+
+        if not self.identities_store:
+            return False
+        key = self.get_sh_map_key(identity, backend_name)
+        uuid = self.identities_store.get_uuid(self.db_sortinghat, key)
+        return uuid is not MISSING
+
+    def add_uuids(self, uuids):
+        """ Cache the uuids already known for identity keys """
+
+        for key, uuid in uuids.items():
+            self.uuids_cache.put((self.db_sortinghat,) + key, uuid)
+            if self.identities_store:
+                self.identities_store.put_uuid(self.db_sortinghat, key, uuid)
+
+    def invalidate_identities(self, uuids):
+        """ Remove from the caches the data for uuids (merged identities) """
+
+        uuids = set(uuids)
+        for uuid in uuids:
+            self.enrollments_cache.invalidate((self.db_sortinghat, uuid))
+            self.unique_identities_cache.invalidate((self.db_sortinghat, uuid))
+        self.uuids_cache.invalidate_values(uuids)
+        if self.identities_store:
+            self.identities_store.invalidate(self.db_sortinghat, uuids)
+
     def get_enrollments(self, uuid):
-        return api.enrollments(self.sh_db, uuid)
+        return self.enrollments_cache.get_or_load(
+            (self.db_sortinghat, uuid),
+            lambda: api.enrollments(self.sh_db, uuid))
 
-    @lru_cache()
     def get_unique_identities(self, uuid):
-        return api.unique_identities(self.sh_db, uuid)
+        return self.unique_identities_cache.get_or_load(
+            (self.db_sortinghat, uuid),
+            lambda: api.unique_identities(self.sh_db, uuid))
+
+    def load_enrollments_index(self):
+        """ Load all the enrollments from Sorting Hat to get_enrollment """
+        self.enrollments_index = EnrollmentsIndex.load(self.sh_db)
+
+    def set_enrollments_index(self, enrollments_index):
+        self.enrollments_index = enrollments_index
+
+    def get_enrollment(self, uuid, date=None):
+        """ Return the organization name for a Sorting Hat uuid at date """
+
+        if self.enrollments_index is None:
+            # All the enrollments are loaded the first time one is needed
+            self.load_enrollments_index()
+        return self.enrollments_index.get_org(uuid, date)
+
+    def is_bot(self, uuid):
+        """ Return if a Sorting Hat uuid is a bot """
+
+        if self.sh_map and uuid in self.sh_map['bots']:
+            return self.sh_map['bots'][uuid]
+
+        if self.identities_store:
+            return self._get_profile_stored(uuid)[1]
+
+        bot = False  # By default, identities are not bots
+        u = self.get_unique_identities(uuid)[0]
+        if u.profile:
+            bot = u.profile.is_bot
+        return bot
+
+    def _get_profile_stored(self, uuid):
+        """ (org_name, bot) for uuid from the store, Sorting Hat if missing """
+
+        profile = self.identities_store.get_profile(self.db_sortinghat, uuid)
+        if profile is MISSING:
+            org_name = self.get_enrollment(uuid)
+            bot = False
+            u = self.get_unique_identities(uuid)[0]
+            if u.profile:
+                bot = u.profile.is_bot
+            profile = (org_name, bot)
+            self.identities_store.put_profile(self.db_sortinghat, uuid,
+                                              org_name, bot)
+        return profile
+
+    @classmethod
+    def get_sh_map_key(cls, identity, backend_name):
+        """ Key for an identity in the Sorting Hat map """
+        return SortingHat.get_identity_key(identity, backend_name)
+
+    def get_sh_map(self, identities, backend_name):
+        """ Resolve identities in Sorting Hat: uuids, orgs and bots
+
+            The map is used instead of Sorting Hat by enrichers in other
+            processes so they don't need to query it.
+        """
+
+        sh_map = {"uuids": {}, "orgs": {}, "bots": {}}
+
+        for identity in identities:
+            uuid = self.get_uuid(identity, backend_name)
+            sh_map['uuids'][self.get_sh_map_key(identity, backend_name)] = uuid
+            if uuid is None or uuid in sh_map['orgs']:
+                continue
+            sh_map['orgs'][uuid] = self.get_enrollment(uuid)
+        sh_map['bots'] = self.get_bots(sh_map['orgs'])
+
+        return sh_map
+
+    def get_bots(self, uuids, batch_size=1000):
+        """ Bot flag for each uuid, reading the profiles in batches """
+
+        bots = {uuid: False for uuid in uuids}
+        uuids = list(bots)
+
+        with self.sh_db.connect() as session:
+            for i in range(0, len(uuids), batch_size):
+                query = session.query(Profile.uuid, Profile.is_bot)
+                query = query.filter(Profile.uuid.in_(uuids[i:i + batch_size]))
+                for uuid, is_bot in query:
+                    bots[uuid] = bool(is_bot)
+
+        return bots
+
+    def set_sh_map(self, sh_map):
+        """ Use sh_map to resolve identities before asking Sorting Hat """
+        self.sh_map = sh_map
 
     def get_uuid(self, identity, backend_name):
         """ Return the Sorting Hat uuid for an identity """
-        # Convert the dict to tuple so it is hashable
-        identity_tuple = tuple(identity.items())
-        uuid = self.__get_uuid_cache(identity_tuple, backend_name)
+
+        key = self.get_sh_map_key(identity, backend_name)
+        if self.sh_map and key in self.sh_map['uuids']:
+            return self.sh_map['uuids'][key]
+
+        uuid = self.uuids_cache.get_or_load(
+            (self.db_sortinghat,) + key,
+            lambda: self._get_uuid_stored(identity, backend_name))
         return uuid
 
-    @lru_cache()
-    def __get_uuid_cache(self, identity_tuple, backend_name):
+    def _get_uuid_stored(self, identity, backend_name):
+        """ Get the uuid for an identity from the store or Sorting Hat """
+
+        store = self.identities_store
+        key = self.get_sh_map_key(identity, backend_name)
+        if store:
+            uuid = store.get_uuid(self.db_sortinghat, key)
+            if uuid is not MISSING:
+                return uuid
+
+        uuid = self._get_uuid_sh(identity, backend_name)
+        if store and uuid is not None:
+            store.put_uuid(self.db_sortinghat, key, uuid)
+        return uuid
 
-        # Convert tuple to the original dict
-        identity = dict((x, y) for x, y in identity_tuple)
+    def _get_uuid_sh(self, identity, backend_name):
+        """ Get the uuid for an identity from Sorting Hat """
 
         if not self.sortinghat:
             raise RuntimeError("Sorting Hat not active during enrich")
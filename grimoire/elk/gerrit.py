@@ -24,13 +24,11 @@
 #
 
 from datetime import datetime
-from dateutil import parser
-import json
 import logging
-import requests
 import time
 
 
+from grimoire.elk.dates import parse_date
 from grimoire.elk.enrich import Enrich
 
 class GerritEnrich(Enrich):
@@ -39,7 +37,6 @@ class GerritEnrich(Enrich):
         super().__init__(sortinghat, db_projects_map)
         self.elastic = None
         self.gerrit = gerrit
-        self.type_name = "items"  # type inside the index to store items enriched
 
     def set_elastic(self, elastic):
         self.elastic = elastic
@@ -73,18 +70,9 @@ class GerritEnrich(Enrich):
         eitem["uuid"] = self.get_uuid(identity, self.get_connector_name())
         eitem["name"] = identity['name']
 
-        enrollments = self.get_enrollments(eitem["uuid"])
-        # TODO: get the org_name for the current commit time
-        if len(enrollments) > 0:
-            eitem["org_name"] = enrollments[0].organization.name
-        else:
-            eitem["org_name"] = None
-        # bot
-        u = self.get_unique_identities(eitem["uuid"])[0]
-        if u.profile:
-            eitem["bot"] = u.profile.is_bot
-        else:
-            eitem["bot"] = False  # By default, identities are not bots
+        # org_name for the review creation time
+        eitem["org_name"] = self.get_enrollment(eitem["uuid"],
+                                                parse_date(item['createdOn']))
         eitem["bot"] = 0  # Not supported yet
 
         if identity['email']:
@@ -109,12 +97,12 @@ class GerritEnrich(Enrich):
         ds_name = "scr"  # data source name in projects map
         url = item['origin']
         repo = url+"_"+item['data']['project']
-        try:
-            project = (self.prjs_map[ds_name][repo])
-        except KeyError:
-            # logging.warning("Project not found for repository %s" % (repo))
-            project = None
-        return {"project": project}
+        return {"project": self.get_project(ds_name, repo)}
+
+    def get_fields_raw_identities(self):
+        return ["data.owner", "data.patchSets.uploader",
+                "data.patchSets.author", "data.patchSets.approvals.by",
+                "data.comments.reviewer"]
 
     def get_identities(self, item):
         ''' Return the identities from an item '''
@@ -154,6 +142,9 @@ class GerritEnrich(Enrich):
         # The eitem _id includes also the patch.
         return eitem["_source"]["review_id"]
 
+    def get_fields_item_id(self):
+        return ["review_id"]
+
     def _fix_review_dates(self, item):
         ''' Convert dates so ES detect them '''
 
@@ -200,7 +191,7 @@ class GerritEnrich(Enrich):
         return {"items":mapping}
 
 
-    def review_item(self, item):
+    def get_rich_item(self, item):
         eitem = {}  # Item enriched
 
         # metadata fields to copy
@@ -240,9 +231,9 @@ class GerritEnrich(Enrich):
         eitem["patchsets"] = len(review["patchSets"])
 
         # Time to add the time diffs
-        createdOn_date = parser.parse(review['createdOn'])
+        createdOn_date = parse_date(review['createdOn'])
         if len(review["patchSets"]) > 0:
-            createdOn_date = parser.parse(review["patchSets"][0]['createdOn'])
+            createdOn_date = parse_date(review["patchSets"][0]['createdOn'])
         seconds_day = float(60*60*24)
         timeopen = \
             (datetime.utcnow()-createdOn_date).total_seconds() / seconds_day
@@ -254,41 +245,4 @@ class GerritEnrich(Enrich):
         if self.prjs_map:
             eitem.update(self.get_item_project(item))
 
-        bulk_json = '{"index" : {"_id" : "%s" } }\n' % (eitem[self.get_field_unique_id()])  # Bulk operation
-        bulk_json += json.dumps(eitem)+"\n"
-
-        return bulk_json
-
-
-    def enrich_items(self, items):
-        """ Fetch in ES patches and comments (events) as documents """
-
-        def send_bulk_json(bulk_json, current):
-            url_bulk = self.elastic.index_url+'/'+self.type_name+'/_bulk'
-            try:
-                task_init = time.time()
-                requests.put(url_bulk, data=bulk_json)
-                logging.debug("bulk packet sent (%.2f sec, %i items)"
-                              % (time.time()-task_init, current))
-            except UnicodeEncodeError:
-                # Why is requests encoding the POST data as ascii?
-                logging.error("Unicode error for events in review: " + review['id'])
-                safe_json = str(bulk_json.encode('ascii', 'ignore'),'ascii')
-                requests.put(url_bulk, data=safe_json)
-                # Continue with execution.
-
-        bulk_json = ""  # json data added in bulk operations
-        total = 0
-        current = 0
-
-        for review in items:
-            if current >= self.elastic.max_items_bulk:
-                send_bulk_json(bulk_json, current)
-                total += current
-                current = 0
-                bulk_json = ""
-            # data_json = self.review_events(review)
-            data_json = self.review_item(review)
-            bulk_json += data_json +"\n"  # Bulk document
-            current += 1
-        send_bulk_json(bulk_json, current)
+        return eitem
@@ -22,12 +22,8 @@
 #   Alvaro del Castillo San Felix <acs@bitergia.com>
 #
 
-import json
-import logging
-import requests
-
-from dateutil import parser
 
+from grimoire.elk.dates import parse_date
 from grimoire.elk.enrich import Enrich
 
 from .github import GITHUB
@@ -68,6 +64,9 @@ class GitEnrich(Enrich):
 
 
 
+    def get_fields_raw_identities(self):
+        return ["data.Author", "data.Commit"]
+
     def get_identities(self, item):
         """ Return the identities from an item """
         identities = []
@@ -99,20 +98,10 @@ class GitEnrich(Enrich):
         identity  = self.get_sh_identity(item["Author"])
         eitem["author_name"] = identity['name']
         eitem["author_uuid"] = self.get_uuid(identity, self.get_connector_name())
-        # enrollments = api.enrollments(self.sh_db, uuid=eitem["author_uuid"])
-        enrollments = self.get_enrollments(eitem["author_uuid"])
-        # TODO: get the org_name for the current commit time
-        if len(enrollments) > 0:
-            eitem["org_name"] = enrollments[0].organization.name
-        else:
-            eitem["org_name"] = None
-        # bot
-        # u = api.unique_identities(self.sh_db, eitem["author_uuid"])[0]
-        u = self.get_unique_identities(eitem["author_uuid"])[0]
-        if u.profile:
-            eitem["bot"] = u.profile.is_bot
-        else:
-            eitem["bot"] = False  # By default, identities are not bots
+        # org_name for the commit time
+        eitem["org_name"] = self.get_enrollment(eitem["author_uuid"],
+                                                parse_date(item["AuthorDate"]))
+        eitem["bot"] = self.is_bot(eitem["author_uuid"])
 
         eitem["domain"] = self.get_identity_domain(identity)
 
@@ -126,14 +115,9 @@ class GitEnrich(Enrich):
         """ Get project mapping enrichment field """
         ds_name = "scm"  # data source name in projects map
         url_git = item['origin']
-        try:
-            project = (self.prjs_map[ds_name][url_git])
-        except KeyError:
-            # logging.warning("Project not found for repository %s" % (url_git))
-            project = None
-        return {"project": project}
-
-    def get_rich_commit(self, item):
+        return {"project": self.get_project(ds_name, url_git)}
+
+    def get_rich_item(self, item):
         eitem = {}
         # metadata fields to copy
         copy_fields = ["metadata__updated_on","metadata__timestamp","ocean-unique-id","origin"]
@@ -160,8 +144,8 @@ class GitEnrich(Enrich):
                 eitem[map_fields[fn]] = None
         eitem['hash_short'] = eitem['hash'][0:6]
         # Enrich dates
-        author_date = parser.parse(commit["AuthorDate"])
-        commit_date = parser.parse(commit["CommitDate"])
+        author_date = parse_date(commit["AuthorDate"])
+        commit_date = parse_date(commit["CommitDate"])
         eitem["author_date"] = author_date.replace(tzinfo=None).isoformat()
         eitem["commit_date"] = commit_date.replace(tzinfo=None).isoformat()
         eitem["utc_author"] = (author_date-author_date.utcoffset()).replace(tzinfo=None).isoformat()
@@ -217,26 +201,3 @@ class GitEnrich(Enrich):
             eitem.update(self.get_item_project(item))
 
         return eitem
-
-    def enrich_items(self, commits):
-        max_items = self.elastic.max_items_bulk
-        current = 0
-        bulk_json = ""
-
-        url = self.elastic.index_url+'/items/_bulk'
-
-        logging.debug("Adding items to %s (in %i packs)" % (url, max_items))
-
-        for commit in commits:
-            if current >= max_items:
-                requests.put(url, data=bulk_json)
-                bulk_json = ""
-                current = 0
-
-            rich_commit = self.get_rich_commit(commit)
-            data_json = json.dumps(rich_commit)
-            bulk_json += '{"index" : {"_id" : "%s" } }\n' % \
-                (rich_commit[self.get_field_unique_id()])
-            bulk_json += data_json +"\n"  # Bulk document
-            current += 1
-        requests.put(url, data = bulk_json)
@@ -23,7 +23,6 @@
 #   Alvaro del Castillo San Felix <acs@bitergia.com>
 #
 
-import json
 import logging
 
 from datetime import datetime
@@ -32,6 +31,7 @@ import requests
 
 from .utils import get_time_diff_days
 
+from grimoire.elk.elastic import BulkWriter
 from grimoire.elk.enrich import Enrich
 
 GITHUB = 'https://github.com/'
@@ -47,6 +47,7 @@ class GitHubEnrich(Enrich):
         self.users = {}  # cache users
         self.location = {}  # cache users location
         self.location_not_found = []  # location not found in map api
+        self.new_geolocations = {}  # found since the last get_new_cache
 
     def set_elastic(self, elastic):
         self.elastic = elastic
@@ -59,6 +60,10 @@ class GitHubEnrich(Enrich):
     def get_fields_uuid(self):
         return ["assignee_uuid", "user_uuid"]
 
+    def get_fields_raw_identities(self):
+        return ["data.user", "data.assignee", "data.user_data",
+                "data.assignee_data"]
+
     def get_identities(self, item):
         """ Return the identities from an item """
         identities = []
@@ -143,6 +148,7 @@ class GitHubEnrich(Enrich):
                     "lon": geo_code['lng']
                 }
                 self.geolocations[location] = geo_point
+                self.new_geolocations[location] = geo_point
 
 
         return geo_point
@@ -159,7 +165,7 @@ class GitHubEnrich(Enrich):
 
         url = self.elastic.url + "/"+index_github
         url += "/_search" + "?" + "size=%i" % res_size
-        r = requests.get(url)
+        r = self.elastic.requests.get(url)
         type_items = r.json()
 
         if 'hits' not in type_items:
@@ -171,7 +177,7 @@ class GitHubEnrich(Enrich):
                     item = hit['_source']
                     cache[item[_key]] = item
                 _from += res_size
-                r = requests.get(url+"&from=%i" % _from)
+                r = self.elastic.requests.get(url+"&from=%i" % _from)
                 type_items = r.json()
                 if 'hits' not in type_items:
                     break
@@ -183,35 +189,23 @@ class GitHubEnrich(Enrich):
         return self.get_github_cache("geolocations", "location")
 
     def geo_locations_to_es(self):
-        max_items = self.elastic.max_items_bulk
-        current = 0
-        bulk_json = ""
-
         url = self.elastic.url + "/github/geolocations/_bulk"
+        bulk = BulkWriter(self.elastic, url=url)
 
-        logging.debug("Adding geoloc to %s (in %i packs)" % (url, max_items))
-
+        logging.debug("Adding geoloc to %s (in %i packs)" % (url,
+                                                             bulk.max_items))
 
         for loc in self.geolocations:
-            if current >= max_items:
-                requests.put(url, data=bulk_json)
-                bulk_json = ""
-                current = 0
-
             geopoint = self.geolocations[loc]
             location = geopoint.copy()
             location["location"] = loc
-            # First upload the raw issue data to ES
-            data_json = json.dumps(location)
             # Don't include in URL non ascii codes
             safe_loc = str(loc.encode('ascii', 'ignore'),'ascii')
             geo_id = str("%s-%s-%s" % (location["lat"], location["lon"],
                                        safe_loc))
-            bulk_json += '{"index" : {"_id" : "%s" } }\n' % (geo_id)
-            bulk_json += data_json +"\n"  # Bulk document
-            current += 1
+            bulk.add(location, geo_id)
 
-        requests.put(url, data = bulk_json)
+        bulk.close()
 
         logging.debug("Adding geoloc to ES Done")
 
@@ -241,7 +235,7 @@ class GitHubEnrich(Enrich):
     def get_field_unique_id(self):
         return "ocean-unique-id"
 
-    def get_rich_issue(self, item):
+    def get_rich_item(self, item):
         rich_issue = {}
 
         # metadata fields to copy
@@ -340,28 +334,15 @@ class GitHubEnrich(Enrich):
 
         return rich_issue
 
-    def enrich_items(self, issues):
-        max_items = self.elastic.max_items_bulk
-        current = 0
-        bulk_json = ""
-
-        url = self.elastic.index_url+'/items/_bulk'
-
-        logging.debug("Adding items to %s (in %i packs)" % (url, max_items))
-
-        for issue in issues:
-            if current >= max_items:
-                requests.put(url, data=bulk_json)
-                bulk_json = ""
-                current = 0
+    def get_new_cache(self):
+        new_geolocations = self.new_geolocations
+        self.new_geolocations = {}
+        return new_geolocations
 
-            rich_issue = self.get_rich_issue(issue)
-            data_json = json.dumps(rich_issue)
-            bulk_json += '{"index" : {"_id" : "%s" } }\n' % (rich_issue[self.get_field_unique_id()])
-            bulk_json += data_json +"\n"  # Bulk document
-            current += 1
-        requests.put(url, data = bulk_json)
+    def add_new_cache(self, geolocations):
+        self.geolocations.update(geolocations)
 
+    def enrich_items_done(self):
         logging.debug("Updating GitHub users geolocations in Elastic")
         self.geo_locations_to_es() # Update geolocations in Elastic
 
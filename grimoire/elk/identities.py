@@ -0,0 +1,393 @@
+#!/usr/bin/python3
+# -*- coding: utf-8 -*-
+#
+# Caches for Sorting Hat identities
+#
+# Copyright (C) 2015 Bitergia
+#
+# This program is free software; you can redistribute it and/or modify
+# it under the terms of the GNU General Public License as published by
+# the Free Software Foundation; either version 3 of the License, or
+# (at your option) any later version.
+#
+# This program is distributed in the hope that it will be useful,
+# but WITHOUT ANY WARRANTY; without even the implied warranty of
+# MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE. See the
+# GNU General Public License for more details.
+#
+# You should have received a copy of the GNU General Public License
+# along with this program; if not, write to the Free Software
+# Foundation, Inc., 59 Temple Place - Suite 330, Boston, MA 02111-1307, USA.
+#
+# Authors:
+#   Alvaro del Castillo San Felix <acs@bitergia.com>
+#
+
+import bisect
+from collections import OrderedDict
+import json
+import logging
+import os
+import sqlite3
+import tempfile
+from threading import Lock
+
+from sortinghat.db.model import Enrollment, Organization
+
+MISSING = object()  # key not in the cache
+
+
+class IdentityCache(object):
+    """ Bounded LRU cache with hits and misses counters
+
+        Values can be None (an identity without uuid) so get() returns
+        MISSING for keys not in the cache.
+    """
+
+    def __init__(self, name, max_size=100000):
+        self.name = name
+        self.max_size = max_size
+        self.items = OrderedDict()
+        self.lock = Lock()  # slices enrich in threads
+        self.hits = 0
+        self.misses = 0
+        self.evictions = 0
+        self.invalidations = 0
+
+    def __len__(self):
+        return len(self.items)
+
+    def get(self, key):
+        with self.lock:
+            try:
+                value = self.items[key]
+            except KeyError:
+                self.misses += 1
+                return MISSING
+            self.items.move_to_end(key)
+            self.hits += 1
+            return value
+
+    def put(self, key, value):
+        with self.lock:
+            self.items[key] = value
+            self.items.move_to_end(key)
+            self._trim()
+
+    def get_or_load(self, key, load):
+        """ Value for key, calling load() to get it if not cached """
+
+        value = self.get(key)
+        if value is MISSING:
+            value = load()
+            self.put(key, value)
+        return value
+
+    def _trim(self):
+        while len(self.items) > self.max_size:
+            self.items.popitem(last=False)
+            self.evictions += 1
+
+    def set_max_size(self, max_size):
+        with self.lock:
+            self.max_size = max_size
+            self._trim()
+
+    def invalidate(self, key):
+        with self.lock:
+            if self.items.pop(key, MISSING) is not MISSING:
+                self.invalidations += 1
+
+    def invalidate_values(self, values):
+        """ Remove the keys with any of values (uuids merged) """
+
+        with self.lock:
+            keys = [key for key, value in self.items.items() if value in values]
+            for key in keys:
+                del self.items[key]
+            self.invalidations += len(keys)
+
+    def clear(self):
+        with self.lock:
+            self.items.clear()
+
+    def get_stats(self):
+        total = self.hits + self.misses
+        stats = {
+            "size": len(self.items),
+            "max_size": self.max_size,
+            "hits": self.hits,
+            "misses": self.misses,
+            "hit_ratio": self.hits / total if total else 0,
+            "evictions": self.evictions,
+            "invalidations": self.invalidations
+        }
+        return stats
+
+
+class IdentityStore(object):
+    """ Sorting Hat uuids, organizations and bots saved in a sqlite file
+
+        It keeps the identities resolved between enrichment runs. Data is
+        saved for each Sorting Hat DB with a watermark of its contents: if
+        the watermark changes (other process modified the identities) the
+        data for the DB is removed and read again from Sorting Hat.
+    """
+
+    commit_writes = 1000  # writes before commiting them to the file
+    mmap_size = 256 * 1024 * 1024  # file bytes memory mapped
+
+    def __init__(self, path):
+        self.path = path
+        self.lock = Lock()
+        self.writes = 0
+        self.conn = sqlite3.connect(path, check_same_thread=False)
+        self.conn.execute("PRAGMA mmap_size=%i" % self.mmap_size)
+        self.conn.execute("PRAGMA journal_mode=WAL")
+        self.conn.executescript("""
+            CREATE TABLE IF NOT EXISTS watermarks (
+                db TEXT PRIMARY KEY, watermark TEXT);
+            CREATE TABLE IF NOT EXISTS uuids (
+                db TEXT, identity TEXT, uuid TEXT,
+                PRIMARY KEY (db, identity));
+            CREATE TABLE IF NOT EXISTS profiles (
+                db TEXT, uuid TEXT, org_name TEXT, bot INTEGER,
+                PRIMARY KEY (db, uuid));
+            CREATE INDEX IF NOT EXISTS uuids_uuid ON uuids (db, uuid);
+        """)
+
+    @classmethod
+    def _get_identity_key(cls, identity_key):
+        return json.dumps(identity_key)
+
+    def _write(self, query, params):
+        with self.lock:
+            self.conn.execute(query, params)
+            self.writes += 1
+            if self.writes >= self.commit_writes:
+                self.conn.commit()
+                self.writes = 0
+
+    def _read(self, query, params):
+        with self.lock:
+            return self.conn.execute(query, params).fetchone()
+
+    def validate(self, db, watermark):
+        """ Remove the data for db if its watermark is not watermark """
+
+        row = self._read("SELECT watermark FROM watermarks WHERE db=?", (db,))
+        if row and row[0] == watermark:
+            return True
+
+        if row:
+            logging.info("Sorting Hat %s changed (%s, was %s): "
+                         "removing its identities from %s" %
+                         (db, watermark, row[0], self.path))
+        with self.lock:
+            self.conn.execute("DELETE FROM uuids WHERE db=?", (db,))
+            self.conn.execute("DELETE FROM profiles WHERE db=?", (db,))
+            self.conn.execute("DELETE FROM watermarks WHERE db=?", (db,))
+            self.conn.commit()
+        return False
+
+    def save(self, db, watermark):
+        """ Commit all the data for db, which is valid for watermark """
+
+        with self.lock:
+            self.conn.execute("INSERT OR REPLACE INTO watermarks VALUES (?,?)",
+                              (db, watermark))
+            self.conn.commit()
+            self.writes = 0
+
+    def get_uuid(self, db, identity_key):
+        row = self._read("SELECT uuid FROM uuids WHERE db=? AND identity=?",
+                         (db, self._get_identity_key(identity_key)))
+        return row[0] if row else MISSING
+
+    def put_uuid(self, db, identity_key, uuid):
+        self._write("INSERT OR REPLACE INTO uuids VALUES (?,?,?)",
+                    (db, self._get_identity_key(identity_key), uuid))
+
+    def get_profile(self, db, uuid):
+        """ (org_name, bot) for uuid """
+        row = self._read("SELECT org_name, bot FROM profiles "
+                         "WHERE db=? AND uuid=?", (db, uuid))
+        return (row[0], bool(row[1])) if row else MISSING
+
+    def put_profile(self, db, uuid, org_name, bot):
+        self._write("INSERT OR REPLACE INTO profiles VALUES (?,?,?,?)",
+                    (db, uuid, org_name, int(bool(bot))))
+
+    def invalidate(self, db, uuids):
+        """ Remove the data for uuids (merged identities) """
+
+        with self.lock:
+            for uuid in uuids:
+                self.conn.execute("DELETE FROM uuids WHERE db=? AND uuid=?",
+                                  (db, uuid))
+                self.conn.execute("DELETE FROM profiles WHERE db=? AND uuid=?",
+                                  (db, uuid))
+            self.conn.commit()
+
+    def close(self):
+        with self.lock:
+            self.conn.commit()
+            self.conn.close()
+
+
+class IdentityCollector(object):
+    """ Unique identities found in a stream of items, with their counts
+
+        Identities are deduplicated with a key built from all their fields.
+        When more than max_memory identities are collected, they are moved
+        to a temporary sqlite file.
+    """
+
+    max_memory = 500000  # identities kept in memory
+
+    def __init__(self, max_memory=None):
+        if max_memory:
+            self.max_memory = max_memory
+        self.counts = {}  # identity key -> occurrences
+        self.conn = None  # spill file
+        self.path = None
+        self.total = 0  # occurrences of all the identities
+        self.unique = 0  # different identities
+
+    @classmethod
+    def get_key(cls, identity):
+        return tuple(sorted(identity.items()))
+
+    def _is_spilled(self, key):
+        return self.conn.execute("SELECT 1 FROM identities WHERE key = ?",
+                                 (json.dumps(key),)).fetchone() is not None
+
+    def add(self, identity):
+        key = self.get_key(identity)
+        count = self.counts.get(key)
+        if count is None:
+            count = 0
+            if not self.conn or not self._is_spilled(key):
+                self.unique += 1
+        self.counts[key] = count + 1
+        self.total += 1
+        if len(self.counts) > self.max_memory:
+            self._spill()
+
+    def add_all(self, identities):
+        for identity in identities:
+            self.add(identity)
+
+    def _spill(self):
+        """ Move the identities in memory to the spill file """
+
+        if not self.conn:
+            fd, self.path = tempfile.mkstemp(prefix="identities-", suffix=".db")
+            os.close(fd)
+            self.conn = sqlite3.connect(self.path)
+            self.conn.execute("CREATE TABLE identities (key TEXT PRIMARY KEY, "
+                              "count INTEGER)")
+            logging.info("Identities collected spilled to %s" % self.path)
+
+        rows = [(json.dumps(key), count) for key, count in self.counts.items()]
+        with self.conn:
+            self.conn.executemany("INSERT OR IGNORE INTO identities "
+                                  "VALUES (?, 0)", [(row[0],) for row in rows])
+            self.conn.executemany("UPDATE identities SET count = count + ? "
+                                  "WHERE key = ?",
+                                  [(row[1], row[0]) for row in rows])
+        self.counts = {}
+
+    def __len__(self):
+        return self.unique
+
+    def items(self):
+        """ (identity, count) for all the identities collected """
+
+        if not self.conn:
+            for key, count in self.counts.items():
+                yield dict(key), count
+            return
+
+        self._spill()
+        for key, count in self.conn.execute("SELECT key, count FROM identities"):
+            yield dict(json.loads(key)), count
+
+    def __iter__(self):
+        for identity, _ in self.items():
+            yield identity
+
+    def get_count(self, identity):
+        key = self.get_key(identity)
+        count = self.counts.get(key, 0)
+        if self.conn:
+            row = self.conn.execute("SELECT count FROM identities WHERE key = ?",
+                                    (json.dumps(key),)).fetchone()
+            count += row[0] if row else 0
+        return count
+
+    def close(self):
+        """ Remove the spill file """
+
+        if self.conn:
+            self.conn.close()
+            os.remove(self.path)
+            self.conn = None
+        self.counts = {}
+        self.unique = 0
+
+
+class EnrollmentsIndex(object):
+    """ Organization of each uuid at a given date
+
+        All the Sorting Hat enrollments are loaded at once. For each uuid
+        they are sorted by start date, so the enrollment for a date is
+        found with a binary search.
+    """
+
+    def __init__(self):
+        self.starts = {}  # uuid -> sorted start dates
+        self.enrollments = {}  # uuid -> [(start, end, org_name)] sorted
+
+    def __len__(self):
+        return len(self.enrollments)
+
+    def add(self, uuid, start, end, org_name):
+        enrollments = self.enrollments.setdefault(uuid, [])
+        pos = bisect.bisect_right(self.starts.setdefault(uuid, []), start)
+        self.starts[uuid].insert(pos, start)
+        enrollments.insert(pos, (start, end, org_name))
+
+    @classmethod
+    def load(cls, db):
+        """ Create the index with all the enrollments in Sorting Hat """
+
+        index = cls()
+        with db.connect() as session:
+            query = session.query(Enrollment.uuid, Enrollment.start,
+                                  Enrollment.end, Organization.name)
+            query = query.join(Organization,
+                               Enrollment.organization_id == Organization.id)
+            for uuid, start, end, org_name in query.yield_per(10000):
+                index.add(uuid, start, end, org_name)
+        logging.info("Loaded enrollments for %i unique identities" % len(index))
+
+        return index
+
+    def get_org(self, uuid, date=None):
+        """ Organization for uuid at date (first enrollment if None) """
+
+        enrollments = self.enrollments.get(uuid)
+        if not enrollments:
+            return None
+        if date is None:
+            return enrollments[0][2]
+
+        if date.tzinfo:
+            date = date.replace(tzinfo=None)
+        pos = bisect.bisect_right(self.starts[uuid], date)
+        # Enrollments could overlap: the last one started including date
+        for start, end, org_name in reversed(enrollments[:pos]):
+            if end >= date:
+                return org_name
+        return None
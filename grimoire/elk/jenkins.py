@@ -22,12 +22,8 @@
 #   Alvaro del Castillo San Felix <acs@bitergia.com>
 #
 
-import json
-import logging
-import requests
-
-from dateutil import parser
 
+from grimoire.elk.dates import parse_date
 from grimoire.elk.enrich import Enrich
 
 from sortinghat import api
@@ -64,6 +60,9 @@ class JenkinsEnrich(Enrich):
         return {"items":mapping}
 
 
+    def get_fields_raw_identities(self):
+        return []
+
     def get_identities(self, item):
         """ Return the identities from an item """
         identities = []
@@ -104,28 +103,5 @@ class JenkinsEnrich(Enrich):
         eitem['job_url'] = eitem['url'].rsplit("/",2)[0]
 
         # Enrich dates
-        eitem["build_date"] = parser.parse(item["metadata__updated_on"]).isoformat()
+        eitem["build_date"] = parse_date(item["metadata__updated_on"]).isoformat()
         return eitem
-
-    def enrich_items(self, items):
-        max_items = self.elastic.max_items_bulk
-        current = 0
-        bulk_json = ""
-
-        url = self.elastic.index_url+'/items/_bulk'
-
-        logging.debug("Adding items to %s (in %i packs)" % (url, max_items))
-
-        for item in items:
-            if current >= max_items:
-                requests.put(url, data=bulk_json)
-                bulk_json = ""
-                current = 0
-
-            rich_item = self.get_rich_item(item)
-            data_json = json.dumps(rich_item)
-            bulk_json += '{"index" : {"_id" : "%s" } }\n' % \
-                (rich_item[self.get_field_unique_id()])
-            bulk_json += data_json +"\n"  # Bulk document
-            current += 1
-        requests.put(url, data = bulk_json)
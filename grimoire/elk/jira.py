@@ -23,11 +23,7 @@
 #   Alvaro del Castillo San Felix <acs@bitergia.com>
 #
 
-from time import time
 from dateutil import parser
-import json
-import logging
-import requests
 from urllib.parse import urlparse
 
 from .enrich import Enrich
@@ -79,6 +75,10 @@ class JiraEnrich(Enrich):
         return eitem
 
 
+    def get_fields_raw_identities(self):
+        return ["data.fields.assignee", "data.fields.reporter",
+                "data.fields.creator"]
+
     def get_identities(self, item):
         ''' Return the identities from an item '''
 
@@ -95,7 +95,7 @@ class JiraEnrich(Enrich):
     def get_field_unique_id(self):
         return "ocean-unique-id"
 
-    def enrich_issue(self, item):
+    def get_rich_item(self, item):
 
         def get_jira_url():
             u = urlparse(self.perceval_backend.url)
@@ -140,72 +140,3 @@ class JiraEnrich(Enrich):
             eitem.update(self.get_item_sh(issue))
 
         return eitem
-
-
-    def enrich_items(self, items):
-#         if self.perceval_backend.detail == "list":
-#             self.issues_list_to_es(items)
-#         else:
-#             self.issues_to_es(items)
-        self.issues_to_es(items)
-
-
-    def issues_list_to_es(self, items):
-
-        elastic_type = "issues_list"
-
-        max_items = self.elastic.max_items_bulk
-        current = 0
-        total = 0
-        bulk_json = ""
-
-        url = self.elastic.index_url+'/' + elastic_type + '/_bulk'
-
-        logging.debug("Adding items to %s (in %i packs)" % (url, max_items))
-
-        # In this client, we will publish all data in Elastic Search
-        for issue in items:
-            if current >= max_items:
-                task_init = time()
-                requests.put(url, data=bulk_json)
-                bulk_json = ""
-                total += current
-                current = 0
-                logging.debug("bulk packet sent (%.2f sec, %i total)"
-                              % (time()-task_init, total))
-            data_json = json.dumps(issue)
-            bulk_json += '{"index" : {"_id" : "%s" } }\n' % (issue[self.get_field_unique_id()])
-            bulk_json += data_json +"\n"  # Bulk document
-            current += 1
-        task_init = time()
-        total += current
-        requests.put(url, data=bulk_json)
-        logging.debug("bulk packet sent (%.2f sec, %i total)"
-                      % (time()-task_init, total))
-
-
-    def issues_to_es(self, items):
-
-        elastic_type = "items"
-
-        max_items = self.elastic.max_items_bulk
-        current = 0
-        bulk_json = ""
-
-        url = self.elastic.index_url+'/' + elastic_type + '/_bulk'
-
-        logging.debug("Adding items to %s (in %i packs)" % (url, max_items))
-
-        for issue in items:
-            if current >= max_items:
-                requests.put(url, data=bulk_json)
-                bulk_json = ""
-                current = 0
-            eitem = self.enrich_issue(issue)
-            data_json = json.dumps(eitem)
-            bulk_json += '{"index" : {"_id" : "%s" } }\n' % (eitem[self.get_field_unique_id()])
-            bulk_json += data_json +"\n"  # Bulk document
-            current += 1
-        requests.put(url, data=bulk_json)
-
-        logging.debug("Adding issues to ES Done")
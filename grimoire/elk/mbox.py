@@ -22,16 +22,13 @@
 #   Alvaro del Castillo San Felix <acs@bitergia.com>
 #
 
-import json
 import logging
-import requests
 
-from dateutil import parser
 import email.utils
 
+from grimoire.elk.dates import parse_date
 from grimoire.elk.enrich import Enrich
 
-from sortinghat import api
 
 class MBoxEnrich(Enrich):
 
@@ -67,6 +64,9 @@ class MBoxEnrich(Enrich):
 
         return {"items":mapping}
 
+    def get_fields_raw_identities(self):
+        return ["data.From"]
+
     def get_identities(self, item):
         """ Return the identities from an item """
         identities = []
@@ -100,6 +100,7 @@ class MBoxEnrich(Enrich):
         """ Add sorting hat enrichment fields """
         eitem = {}  # Item enriched
 
+        date = parse_date(item['metadata__updated_on'])
         item = item['data']
 
         # Enrich SH
@@ -108,18 +109,8 @@ class MBoxEnrich(Enrich):
         identity  = self.get_sh_identity(item["From"])
         eitem["from_uuid"] = self.get_uuid(identity, self.get_connector_name())
         eitem["from_name"] = identity['name']
-        # bot
-        u = api.unique_identities(self.sh_db, eitem["from_uuid"])[0]
-        if u.profile:
-            eitem["from_bot"] = u.profile.is_bot
-        else:
-            eitem["from_bot"] = False  # By default, identities are not bots
-
-        enrollments = self.get_enrollments(eitem["from_uuid"])
-        if len(enrollments) > 0:
-            eitem["from_org_name"] = enrollments[0].organization.name
-        else:
-            eitem["from_org_name"] = None
+        eitem["from_bot"] = self.is_bot(eitem["from_uuid"])
+        eitem["from_org_name"] = self.get_enrollment(eitem["from_uuid"], date)
 
         if identity['email']:
             try:
@@ -145,13 +136,7 @@ class MBoxEnrich(Enrich):
         mls_list = item['origin']
         path = "/mnt/mailman_archives/"
         path += mls_list+".mbox/"+mls_list+".mbox"
-
-        try:
-            project = (self.prjs_map[ds_name][path])
-        except KeyError:
-            # logging.warning("Project not found for list %s" % (mls_list))
-            project = None
-        return {"project": project}
+        return {"project": self.get_project(ds_name, path)}
 
     def get_rich_item(self, item):
         eitem = {}
@@ -180,7 +165,7 @@ class MBoxEnrich(Enrich):
             eitem[map_fields[fn]] = message[fn]
 
         # Enrich dates
-        eitem["email_date"] = parser.parse(item["metadata__updated_on"]).isoformat()
+        eitem["email_date"] = parse_date(item["metadata__updated_on"]).isoformat()
         eitem["list"] = item["origin"]
 
         # Root message
@@ -197,7 +182,7 @@ class MBoxEnrich(Enrich):
 
         # Time zone
         try:
-            message_date = parser.parse(message['Date'])
+            message_date = parse_date(message['Date'])
             eitem["tz"]  = int(message_date.strftime("%z")[0:3])
         except:
             eitem["tz"]  = None
@@ -209,32 +194,3 @@ class MBoxEnrich(Enrich):
             eitem.update(self.get_item_project(item))
 
         return eitem
-
-    def enrich_items(self, items):
-        max_items = self.elastic.max_items_bulk
-        current = 0
-        bulk_json = ""
-
-        url = self.elastic.index_url+'/items/_bulk'
-
-        logging.debug("Adding items to %s (in %i packs)" % (url, max_items))
-
-        for item in items:
-            if current >= max_items:
-                requests.put(url, data=bulk_json)
-                bulk_json = ""
-                current = 0
-
-            rich_item = self.get_rich_item(item)
-            data_json = json.dumps(rich_item)
-            bulk_json += '{"index" : {"_id" : "%s" } }\n' % \
-                (rich_item[self.get_field_unique_id()])
-            bulk_json += data_json +"\n"  # Bulk document
-            current += 1
-        try:
-            requests.put(url, data = bulk_json)
-        except UnicodeEncodeError:
-            # Related to body.encode('iso-8859-1'). mbox data
-            logging.error("Encoding error ... converting bulk to iso-8859-1")
-            bulk_json = bulk_json.encode('iso-8859-1','ignore')
-            requests.put(url, data=bulk_json)
@@ -23,13 +23,24 @@
 #   Alvaro del Castillo San Felix <acs@bitergia.com>
 #
 
+import csv
+import json
+import logging
+import re
+from threading import Lock
+from urllib.parse import unquote_plus, urlparse
+
 from grimoire.elk.database import Database
 
 class GrimoireLibProjects(object):
 
-    def __init__(self, projects_db, repository):
+    def __init__(self, projects_db, repository, user="root", passwd="",
+                 host="localhost", port=3306):
         self.projects_db = projects_db
         self.repository = repository
+        self.db = Database(user = user, passwd = passwd, host = host,
+                           port = port, scrdb = None, shdb = projects_db,
+                           prjdb = None)
 
 
     def get_projects(self):
@@ -37,19 +48,13 @@ class GrimoireLibProjects(object):
 
         repos_list = []
 
-        gerrit_projects_db = self.projects_db
-
-        db = Database (user = "root", passwd = "",
-                       host = "localhost", port = 3306,
-                       scrdb = None, shdb = gerrit_projects_db, prjdb = None)
-
         sql = """
             SELECT DISTINCT(repository_name)
             FROM project_repositories
-            WHERE data_source='scr'
+            WHERE data_source=%s
         """
 
-        repos_list_raw = db.execute(sql)
+        repos_list_raw = self.db.iterate(sql, ("scr",))
 
         # Convert from review.openstack.org_openstack/rpm-packaging-tools to
         # openstack_rpm-packaging-tools
@@ -59,3 +64,154 @@ class GrimoireLibProjects(object):
             repos_list.append(repo_name)
 
         return repos_list
+
+
+class ProjectsIndex(object):
+    """ Project for the repositories of each data source (projects map)
+
+        Repositories are compared normalized (no scheme, lower case host,
+        no trailing / or .git) and, if not found, the longest path prefix
+        with a project is used. The map is read from a projects DB or a
+        JSON/CSV file the first time it is used, once for all the
+        enrichers in the process (get_index).
+    """
+
+    indexes = {}  # source -> ProjectsIndex shared in the process
+    indexes_lock = Lock()
+
+    def __init__(self, source=None, prjs_map=None):
+        self.source = source  # DB name or JSON/CSV file
+        self.lock = Lock()
+        self.repos = None  # data source -> {normalized repo: project}
+        self.cache = {}  # (data source, repo) -> project
+        if prjs_map is not None:
+            self._set_map(prjs_map)
+
+    def __bool__(self):
+        return True
+
+    def __getstate__(self):
+        # Indexes are sent to the enrich worker processes
+        state = self.__dict__.copy()
+        del state['lock']
+        return state
+
+    def __setstate__(self, state):
+        self.__dict__.update(state)
+        self.lock = Lock()
+
+    @classmethod
+    def get_index(cls, source):
+        """ Shared index for source """
+
+        with cls.indexes_lock:
+            if source not in cls.indexes:
+                cls.indexes[source] = cls(source)
+            return cls.indexes[source]
+
+    @classmethod
+    def normalize(cls, repo):
+        """ Normalized repository URL or path """
+
+        repo = unquote_plus(repo.strip())
+        parsed = urlparse(repo)
+        if parsed.scheme and parsed.netloc:
+            repo = parsed.netloc.lower() + parsed.path
+            if parsed.query:
+                repo = repo.rstrip("/") + "?" + parsed.query
+        repo = repo.rstrip("/")
+        if repo.endswith(".git"):
+            repo = repo[:-4]
+        return repo
+
+    def _set_map(self, prjs_map):
+        repos = {}
+        for ds, ds_repos in prjs_map.items():
+            repos[ds] = {}
+            for repo, project in ds_repos.items():
+                repos[ds][self.normalize(repo)] = project
+        self.repos = repos
+        self.cache = {}
+
+    def load(self):
+        """ Read the projects map from self.source """
+
+        if self.source.endswith(".json"):
+            prjs_map = self.read_json(self.source)
+        elif self.source.endswith(".csv"):
+            prjs_map = self.read_csv(self.source)
+        else:
+            prjs_map = self.read_db(self.source)
+        self._set_map(prjs_map)
+        logging.info("Projects map loaded from %s: %i repositories" %
+                     (self.source, sum(len(r) for r in self.repos.values())))
+
+    @classmethod
+    def read_db(cls, db_projects_map):
+        prjs_map = {}
+
+        db = Database(user = "root", passwd = "", host = "mariadb",
+                      port = 3306, scrdb = None, shdb = db_projects_map,
+                      prjdb = None)
+
+        query = """
+        SELECT data_source, p.id, pr.repository_name
+        FROM projects p
+        JOIN project_repositories pr ON p.project_id=pr.project_id
+        """
+
+        for row in db.iterate(query):
+            [ds, name, repo] = row
+            if ds not in prjs_map:
+                prjs_map[ds] = {}
+            prjs_map[ds][repo] = name
+        if not prjs_map:
+            raise RuntimeError("Can't find projects mapping in %s" % (db_projects_map))
+        return prjs_map
+
+    @classmethod
+    def read_json(cls, path):
+        """ {"data source": {"repository": "project"}} """
+        with open(path) as f:
+            return json.load(f)
+
+    @classmethod
+    def read_csv(cls, path):
+        """ Rows with data_source, project and repository columns """
+
+        prjs_map = {}
+        with open(path) as f:
+            for row in csv.DictReader(f):
+                ds_repos = prjs_map.setdefault(row['data_source'], {})
+                ds_repos[row['repository']] = row['project']
+        return prjs_map
+
+    def get_project(self, ds, repo):
+        """ Project for repo in data source ds, None if not found """
+
+        key = (ds, repo)
+        if key in self.cache:
+            return self.cache[key]
+
+        if self.repos is None:
+            with self.lock:
+                if self.repos is None:
+                    self.load()
+
+        ds_repos = self.repos.get(ds, {})
+        project = None
+        prefix = self.normalize(repo)
+        while prefix:
+            if prefix in ds_repos:
+                project = ds_repos[prefix]
+                break
+            # Try the parent path (or the URL without query)
+            parent = re.sub(r"[/?][^/?]*$", "", prefix)
+            if parent == prefix:
+                break
+            prefix = parent
+
+        if project is None:
+            logging.debug("Project not found for %s repository %s" % (ds, repo))
+        self.cache[key] = project
+        return project
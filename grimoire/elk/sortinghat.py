@@ -25,93 +25,325 @@
 
 from datetime import datetime
 import logging
+import re
+import unicodedata
+
+from sqlalchemy.exc import IntegrityError
 
 from sortinghat import api
-from sortinghat.db.model import UniqueIdentity
-from sortinghat.exceptions import AlreadyExistsError, NotFoundError, WrappedValueError
-from sortinghat.matcher import create_identity_matcher
+from sortinghat import utils as sh_utils
+from sortinghat.db.model import Identity, UniqueIdentity
+from sortinghat.exceptions import AlreadyExistsError, NotFoundError
 
 logger = logging.getLogger(__name__)
 
 class SortingHat(object):
 
-    @classmethod
-    def add_identities(cls, db, identities, backend):
-        """ Load identities list from backend in Sorting Hat """
-
-        merge_identities = False
-
-        logger.info("Adding the identities to SortingHat")
-        if not merge_identities:
-            logger.info("Not doing identities merge")
+    bulk_size = 1000  # identities in each query and insert transaction
 
-        total = 0
-        lidentities = len(identities)
+    @classmethod
+    def get_identity_key(cls, identity, backend):
+        """ Key for an identity in the uuids maps """
+        return (backend, identity.get('email'), identity.get('name'),
+                identity.get('username'))
 
+    @classmethod
+    def _add_company(cls, db, uuid, company):
+        try:
+            api.add_organization(db, company)
+        except AlreadyExistsError:
+            pass
+        try:
+            api.add_enrollment(db, uuid, company, datetime(1900, 1, 1),
+                               datetime(2100, 1, 1))
+        except AlreadyExistsError:
+            pass
 
-        if merge_identities:
-            merged_identities = []  # old identities merged into new ones
-            blacklist = api.blacklist(db)
-            matching = 'email-name'  # Not active
-            matcher = create_identity_matcher(matching, blacklist)
+    @classmethod
+    def _get_identities_ids(cls, identities, backend):
+        """ Sorting Hat id for each identity: {id: identity} """
 
+        ids = {}
         for identity in identities:
             try:
-                uuid = api.add_identity(db, backend, identity['email'],
-                                        identity['name'], identity['username'])
-
-                logger.info("New sortinghat identity %s %s %s (%i/%i)" % \
-                            (uuid, identity['name'], identity['email'],
-                            total, lidentities))
-
-                total += 1
-                if not merge_identities:
-                    continue  # Don't do the merge here. Too slow in large projects
-
-                # Time to  merge
-                matches = api.match_identities(db, uuid, matcher)
-
-                if len(matches) > 1:
-                    u = api.unique_identities(db, uuid)[0]
-                    for m in matches:
-                        # First add the old uuid to the list of changed by merge uuids
-                        if m.uuid not in merged_identities:
-                            merged_identities.append(m.uuid)
-                        if m.uuid == uuid:
-                            continue
-                        # Merge matched identity into added identity
-                        api.merge_unique_identities(db, m.uuid, u.uuid)
-                        # uuid = m.uuid
-                        # u = api.unique_identities(db, uuid, backend)[0]
-                        # Include all identities related to this uuid
-                        # merged_identities.append(m.uuid)
-
-            except AlreadyExistsError as ex:
-                uuid = ex.uuid
-                continue
-            except WrappedValueError as ex:
+                identity_id = sh_utils.uuid(backend, email=identity['email'],
+                                            name=identity['name'],
+                                            username=identity['username'])
+            except ValueError:
                 logging.warning("Trying to add a None identity. Ignoring it.")
                 continue
-            except UnicodeEncodeError as ex:
+            except UnicodeEncodeError:
                 logging.warning("UnicodeEncodeError. Ignoring it. %s %s %s" % \
                                 (identity['email'], identity['name'],
                                 identity['username']))
                 continue
+            ids[identity_id] = identity
+        return ids
 
-            if 'company' in identity and identity['company'] is not None:
-                try:
-                    api.add_organization(db, identity['company'])
-                    api.add_enrollment(db, uuid, identity['company'],
-                                       datetime(1900, 1, 1),
-                                       datetime(2100, 1, 1))
-                except AlreadyExistsError:
-                    pass
+    @classmethod
+    def _add_identities_batch(cls, db, ids, backend):
+        """ Insert the identities in ids in a transaction
+
+            Return the ids inserted. If the transaction fails (other process
+            added some of them) the identities are added one by one.
+        """
+
+        try:
+            with db.connect() as session:
+                for identity_id, identity in ids.items():
+                    session.add(UniqueIdentity(uuid=identity_id))
+                    session.add(Identity(id=identity_id, uuid=identity_id,
+                                         source=backend,
+                                         email=identity['email'],
+                                         name=identity['name'],
+                                         username=identity['username']))
+            return list(ids)
+        except IntegrityError:
+            logger.debug("Can't insert %i identities at once. Adding them "
+                         "one by one." % len(ids))
+
+        added = []
+        for identity_id, identity in ids.items():
+            try:
+                api.add_identity(db, backend, identity['email'],
+                                 identity['name'], identity['username'])
+                added.append(identity_id)
+            except AlreadyExistsError:
+                pass
+        return added
+
+    @classmethod
+    def add_identities_bulk(cls, db, identities, backend):
+        """ Add the missing identities to Sorting Hat in batches
+
+            The identities already in Sorting Hat are found with a query for
+            each batch and the rest are inserted in a transaction per batch.
+            Return the uuid for each identity key (get_identity_key).
+        """
+
+        ids = cls._get_identities_ids(identities, backend)
+        ids_list = list(ids)
+        uuids = {}
+        total = 0
+
+        for i in range(0, len(ids_list), cls.bulk_size):
+            batch = ids_list[i:i + cls.bulk_size]
+
+            with db.connect() as session:
+                query = session.query(Identity.id, Identity.uuid)
+                existing = dict(query.filter(Identity.id.in_(batch)).all())
+
+            new_ids = {identity_id: ids[identity_id] for identity_id in batch
+                       if identity_id not in existing}
+            if new_ids:
+                added = cls._add_identities_batch(db, new_ids, backend)
+                total += len(added)
+                for identity_id in added:
+                    identity = ids[identity_id]
+                    if identity.get('company'):
+                        cls._add_company(db, identity_id, identity['company'])
+                if len(added) < len(new_ids):
+                    # Identities added by other process: read their uuids
+                    with db.connect() as session:
+                        query = session.query(Identity.id, Identity.uuid)
+                        existing.update(query.filter(
+                            Identity.id.in_(list(new_ids))).all())
+
+            for identity_id in batch:
+                uuid = existing.get(identity_id, identity_id)
+                uuids[cls.get_identity_key(ids[identity_id], backend)] = uuid
+
+            logger.debug("Identities checked in Sorting Hat: %i/%i (%i new)" %
+                         (min(i + cls.bulk_size, len(ids_list)), len(ids_list),
+                          total))
 
         logger.info("Total NEW identities: %i" % (total))
 
-        if merge_identities:
-            logger.info("Total NEW identities merged: %i" % \
-                        (len(merged_identities)))
-            return merged_identities
-        else:
+        return uuids
+
+    @classmethod
+    def merge_identities(cls, db, uuids=None):
+        """ Merge the unique identities matched by IdentityMatcher
+
+            Only identities sharing a block with identities of uuids are
+            compared (all if None). Return the uuids merged (from and to).
+        """
+
+        blacklist = [b.excluded for b in api.blacklist(db)]
+        matcher = IdentityMatcher(blacklist)
+
+        with db.connect() as session:
+            query = session.query(Identity.id, Identity.uuid, Identity.email,
+                                  Identity.name)
+            for identity_id, uuid, email, name in query.yield_per(cls.bulk_size):
+                matcher.add(identity_id, uuid, email, name)
+
+        groups = matcher.match(uuids)
+        logger.info("Unique identities to be merged: %i groups" % len(groups))
+
+        merged_identities = []
+        for group in groups:
+            # Merge into the uuid with more identities
+            to_uuid = max(group, key=lambda uuid: (matcher.uuids_count[uuid],
+                                                   uuid))
+            for from_uuid in group:
+                if from_uuid == to_uuid:
+                    continue
+                try:
+                    api.merge_unique_identities(db, from_uuid, to_uuid)
+                except NotFoundError as ex:
+                    logger.warning("Can't merge %s into %s: %s" %
+                                   (from_uuid, to_uuid, ex))
+                    continue
+            merged_identities += group
+            logger.debug("Merged %s into %s" % (group, to_uuid))
+
+        logger.info("Total NEW identities merged: %i" % (len(merged_identities)))
+
+        return merged_identities
+
+    @classmethod
+    def add_identities(cls, db, identities, backend, uuids=None, merge=False):
+        """ Load identities list from backend in Sorting Hat
+
+            Return the uuids merged. If uuids is a dict, it is updated with
+            the uuid for each identity key (get_identity_key).
+        """
+
+        logger.info("Adding the identities to SortingHat")
+
+        identities_uuids = cls.add_identities_bulk(db, identities, backend)
+        if uuids is not None:
+            uuids.update(identities_uuids)
+
+        if not merge:
+            logger.info("Not doing identities merge")
             return []
+
+        return cls.merge_identities(db, set(identities_uuids.values()))
+
+
+class IdentityMatcher(object):
+    """ Find the unique identities of the same person
+
+        Identities are grouped in blocks by normalized email, email local
+        part and name key (sorted name tokens). Only identities in the same
+        block are compared, so matching is not quadratic in the number of
+        identities. Identities match if they have the same email or name
+        key, or the same local part and at least min_name_tokens common
+        name tokens (a first name or surname alone is not enough).
+    """
+
+    max_block = 1000  # bigger blocks are too generic to be used
+    min_local_part = 3
+    min_name_tokens = 2  # common name tokens to match a local part
+    generic_local_parts = ['admin', 'bugs', 'dev', 'info', 'mail', 'no-reply',
+                           'noreply', 'root', 'support', 'user', 'webmaster']
+
+    def __init__(self, blacklist=None):
+        self.blacklist = set(b.lower() for b in (blacklist or []))
+        self.blocks = {}  # block key -> identity ids
+        self.identities = {}  # identity id -> (uuid, local part, name tokens)
+        self.uuids_count = {}  # uuid -> identities
+        self.parent = {}  # union-find of uuids
+
+    @classmethod
+    def get_email(cls, email):
+        if not email or '@' not in email:
+            return None
+        return email.strip().lower()
+
+    @classmethod
+    def get_local_part(cls, email):
+        local = email.split('@')[0].split('+')[0]
+        if len(local) < cls.min_local_part or local in cls.generic_local_parts:
+            return None
+        return local
+
+    @classmethod
+    def get_name_tokens(cls, name):
+        if not name:
+            return ()
+        name = unicodedata.normalize('NFKD', name)
+        name = "".join(c for c in name if not unicodedata.combining(c))
+        return tuple(sorted(set(re.findall(r'\w+', name.lower()))))
+
+    def _add_block(self, key, identity_id):
+        self.blocks.setdefault(key, []).append(identity_id)
+
+    def add(self, identity_id, uuid, email, name):
+        email = self.get_email(email)
+        if email in self.blacklist:
+            email = None
+        if name and name.lower() in self.blacklist:
+            name = None
+        local = self.get_local_part(email) if email else None
+        tokens = self.get_name_tokens(name)
+
+        self.identities[identity_id] = (uuid, local, tokens)
+        self.uuids_count[uuid] = self.uuids_count.get(uuid, 0) + 1
+        self.parent.setdefault(uuid, uuid)
+
+        if email:
+            self._add_block(('email', email), identity_id)
+        if local:
+            self._add_block(('local', local), identity_id)
+        if len(tokens) > 1:
+            # A single name (John) is not enough to identify someone
+            self._add_block(('name', tokens), identity_id)
+
+    def _find(self, uuid):
+        root = uuid
+        while self.parent[root] != root:
+            root = self.parent[root]
+        while self.parent[uuid] != root:
+            self.parent[uuid], uuid = root, self.parent[uuid]
+        return root
+
+    def _union(self, uuid1, uuid2):
+        root1 = self._find(uuid1)
+        root2 = self._find(uuid2)
+        if root1 != root2:
+            self.parent[root2] = root1
+
+    def _match_block(self, key, identity_ids):
+        if key[0] != 'local':
+            # Same email or name key
+            first = self.identities[identity_ids[0]][0]
+            for identity_id in identity_ids[1:]:
+                self._union(first, self.identities[identity_id][0])
+            return
+
+        # Same local part: compare the names
+        for i, id1 in enumerate(identity_ids):
+            (uuid1, _, tokens1) = self.identities[id1]
+            for id2 in identity_ids[i + 1:]:
+                (uuid2, _, tokens2) = self.identities[id2]
+                if len(set(tokens1) & set(tokens2)) >= self.min_name_tokens:
+                    self._union(uuid1, uuid2)
+
+    def match(self, uuids=None):
+        """ Groups of uuids matched, with blocks including uuids (all if None) """
+
+        uuids = set(uuids) if uuids is not None else None
+        skipped = 0
+
+        for key, identity_ids in self.blocks.items():
+            if len(identity_ids) < 2:
+                continue
+            if len(identity_ids) > self.max_block:
+                skipped += 1
+                continue
+            if uuids is not None and \
+                not any(self.identities[i][0] in uuids for i in identity_ids):
+                continue
+            self._match_block(key, identity_ids)
+
+        if skipped:
+            logger.debug("%i blocks too big not used in matching" % skipped)
+
+        groups = {}
+        for uuid in self.parent:
+            groups.setdefault(self._find(uuid), []).append(uuid)
+
+        return [group for group in groups.values() if len(group) > 1]
@@ -24,7 +24,8 @@
 #
 
 import datetime
-from dateutil import parser
+
+from .dates import parse_date
 
 def get_time_diff_days(start, end):
     ''' Number of days between two dates in UTC format  '''
@@ -33,9 +34,9 @@ def get_time_diff_days(start, end):
         return None
 
     if type(start) is not datetime.datetime:
-        start = parser.parse(start).replace(tzinfo=None)
+        start = parse_date(start).replace(tzinfo=None)
     if type(end) is not datetime.datetime:
-        end = parser.parse(end).replace(tzinfo=None)
+        end = parse_date(end).replace(tzinfo=None)
 
     seconds_day = float(60*60*24)
     diff_days = \
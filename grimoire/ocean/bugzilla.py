@@ -30,6 +30,8 @@ from grimoire.ocean.elastic import ElasticOcean
 
 class BugzillaOcean(ElasticOcean):
 
+    fetch_ordered = True  # sorted by update date
+
     def _fix_item(self, item):
         bug_id = item["data"]["bug_id"][0]['__text__']
         item["ocean-unique-id"] = bug_id+"_"+item['origin']
@@ -25,14 +25,15 @@
 
 '''Ocean Configuration Manager (singleton) '''
 
+from datetime import datetime
 import json
 import logging
-import requests
 
 class ConfOcean(object):
 
     conf_index = "conf"
     conf_repos = conf_index+"/repos"
+    conf_checkpoints = conf_index+"/checkpoints"
     elastic = None
 
     @classmethod
@@ -45,9 +46,9 @@ class ConfOcean(object):
 
         # Check conf index
         url = elastic.url + "/" + cls.conf_index
-        r = requests.get(url)
+        r = elastic.requests.get(url)
         if r.status_code != 200:
-            requests.post(url)
+            elastic.requests.post(url)
             logging.info("Creating OceanConf index " + url)
 
 
@@ -64,7 +65,7 @@ class ConfOcean(object):
 
         logging.debug("Adding repo to Ocean %s %s" % (url, repo))
 
-        requests.post(url, data = json.dumps(repo))
+        cls.elastic.requests.post(url, data = json.dumps(repo))
 
     @classmethod
     def get_repos(cls):
@@ -79,7 +80,7 @@ class ConfOcean(object):
         # TODO: use scrolling API for getting all repos
         url = cls.elastic.url + "/" + cls.conf_repos + "/_search?size=9999"
 
-        r = requests.get(url).json()
+        r = cls.elastic.requests.get(url).json()
 
         if 'hits' in r:
 
@@ -101,10 +102,200 @@ class ConfOcean(object):
 
         url = cls.elastic.url + "/" + cls.conf_repos + "/_search"
 
-        r = requests.get(url).json()
+        r = cls.elastic.requests.get(url).json()
 
         if 'hits' in r:
             repos_raw = r['hits']['hits']  # Already existing items
             [ repos_ids.append(rep['_id']) for rep in repos_raw ]
 
         return repos_ids
+
+    @classmethod
+    def get_checkpoint(cls, checkpoint_id):
+        ''' Checkpoint data with checkpoint_id, None if not found '''
+
+        if cls.elastic is None:
+            logging.error("Can't get checkpoint. Ocean elastic is not configured")
+            return
+
+        url = cls.elastic.url + "/" + cls.conf_checkpoints + "/"
+        url += cls.elastic.safe_index(checkpoint_id)
+
+        r = cls.elastic.requests.get(url)
+        if r.status_code != 200:
+            return None
+
+        return r.json().get('_source')
+
+    @classmethod
+    def set_checkpoint(cls, checkpoint_id, checkpoint):
+        ''' Replace the checkpoint data with checkpoint_id '''
+
+        if cls.elastic is None:
+            logging.error("Can't set checkpoint. Ocean elastic is not configured")
+            return
+
+        url = cls.elastic.url + "/" + cls.conf_checkpoints + "/"
+        url += cls.elastic.safe_index(checkpoint_id)
+
+        r = cls.elastic.requests.put(url, data = json.dumps(checkpoint))
+        if r.status_code not in (200, 201):
+            logging.error("Can't set checkpoint %s: %s" % (url, r.text))
+
+    @classmethod
+    def remove_checkpoint(cls, checkpoint_id):
+        ''' Remove the checkpoint data with checkpoint_id '''
+
+        if cls.elastic is None:
+            logging.error("Can't remove checkpoint. Ocean elastic is not configured")
+            return
+
+        url = cls.elastic.url + "/" + cls.conf_checkpoints + "/"
+        url += cls.elastic.safe_index(checkpoint_id)
+
+        cls.elastic.requests.delete(url)
+
+
+class FeedCheckpoint(object):
+    ''' Progress of a feed for an origin, to resume it if interrupted
+
+        It has the highest updated_on up to which all the items fetched are
+        stored (the run start date if items are not fetched in updated_on
+        order) and the offset of the last item stored, if the Perceval
+        backend has one. It is removed once the feed finishes.
+    '''
+
+    def __init__(self, index, origin, ordered=False):
+        self.id = "feed_" + index + "_" + origin
+        self.data = {
+            "index": index,
+            "origin": origin
+        }
+        self.ordered = ordered  # items are fetched in updated_on order
+        self.updated_on = None  # epoch all the items are stored up to
+        self.offset = None  # Perceval offset of the last item stored
+        self.mark_updated_on = None
+
+    def load(self):
+        ''' Read the checkpoint of an interrupted feed. False if not found '''
+
+        checkpoint = ConfOcean.get_checkpoint(self.id)
+        if not checkpoint:
+            return False
+        self.updated_on = checkpoint['updated_on']
+        self.offset = checkpoint['offset']
+        return True
+
+    def get_from_date(self):
+        ''' Date to resume the fetch from (None from the beginning) '''
+
+        if self.updated_on is None:
+            return None
+        return datetime.fromtimestamp(self.updated_on)
+
+    def start(self, from_date):
+        ''' Save the checkpoint for a feed fetching from from_date '''
+
+        self.updated_on = None
+        if from_date:
+            self.updated_on = from_date.replace(tzinfo=None).timestamp()
+        self.mark_updated_on = self.updated_on
+        self.commit((self.updated_on, self.offset))
+
+    def mark(self, item):
+        ''' Mark for BulkWriter.add_mark() after adding a fetched item '''
+
+        if self.ordered:
+            if self.mark_updated_on is None or \
+                item['updated_on'] >= self.mark_updated_on:
+                self.mark_updated_on = item['updated_on']
+            else:
+                # Older items could come later: stop moving the date
+                logging.warning("Items not fetched in date order for %s" %
+                                self.data['origin'])
+                self.ordered = False
+        return (self.mark_updated_on, item.get('offset'))
+
+    def commit(self, mark):
+        ''' Save the checkpoint once the items for mark are stored '''
+
+        self.updated_on, self.offset = mark
+
+        checkpoint = dict(self.data)
+        checkpoint['updated_on'] = self.updated_on
+        checkpoint['offset'] = self.offset
+        ConfOcean.set_checkpoint(self.id, checkpoint)
+
+    def remove(self):
+        ''' Feed finished: the next one goes on from the items stored '''
+
+        ConfOcean.remove_checkpoint(self.id)
+
+
+class EnrichCheckpoint(object):
+    ''' Last raw item enriched for an origin in an enriched index
+
+        Raw items are enriched in metadata__timestamp order. The checkpoint
+        has the last timestamp enriched and the ids of the items with it, so
+        the next incremental enrichment starts just after them.
+    '''
+
+    def __init__(self, backend_name, origin, enrich_index):
+        self.id = backend_name + "_" + origin + "_" + enrich_index
+        self.data = {
+            "backend_name": backend_name,
+            "origin": origin,
+            "enrich_index": enrich_index
+        }
+        self.timestamp = None  # last metadata__timestamp committed
+        self.ids = []  # items enriched with timestamp
+        self.mark_timestamp = None  # last metadata__timestamp marked
+        self.mark_ids = []
+        self.blocked = False  # items not delivered: don't commit any more
+
+    def block(self):
+        ''' Don't move the checkpoint beyond items not delivered in this run '''
+        self.blocked = True
+
+    def load(self):
+        ''' Read the checkpoint from Ocean conf. False if not found '''
+
+        checkpoint = ConfOcean.get_checkpoint(self.id)
+        if not checkpoint:
+            return False
+        self.timestamp = checkpoint['metadata__timestamp']
+        self.ids = checkpoint['ids']
+        self.mark_timestamp = self.timestamp
+        self.mark_ids = list(self.ids)
+        return True
+
+    def mark(self, item):
+        ''' Mark for BulkWriter.add_mark() after enriching a raw item '''
+
+        timestamp = item['metadata__timestamp']
+        if timestamp != self.mark_timestamp:
+            # Items already marked keep their own ids list
+            self.mark_timestamp = timestamp
+            self.mark_ids = []
+        self.mark_ids.append(item['ocean-unique-id'])
+        return (timestamp, self.mark_ids, len(self.mark_ids))
+
+    def commit(self, mark):
+        ''' Save the checkpoint once the items for mark are uploaded '''
+
+        if self.blocked:
+            return
+
+        timestamp, ids, nids = mark
+        self.timestamp = timestamp
+        self.ids = ids[:nids]
+
+        checkpoint = dict(self.data)
+        checkpoint['metadata__timestamp'] = self.timestamp
+        checkpoint['ids'] = self.ids
+        ConfOcean.set_checkpoint(self.id, checkpoint)
+
+    def remove(self):
+        ''' No items enriched yet: start from the first raw item '''
+
+        ConfOcean.remove_checkpoint(self.id)
@@ -29,10 +29,22 @@
 from datetime import datetime
 import json
 import logging
-import requests
+
+from grimoire.elk import codec
+from grimoire.elk.elastic import BulkWriter
+from grimoire.ocean.conf import ConfOcean, FeedCheckpoint
+from grimoire.pipeline import Pipeline
 
 class ElasticOcean(object):
 
+    elastic_page_bytes = 5 * 1024 * 1024  # target size of scroll pages
+    elastic_page_min = 10  # min items in a scroll page
+    elastic_page_max = 5000  # max items in a scroll page
+    elastic_page_probe = 10  # items read to find the scroll page size
+    elastic_prefetch_pages = 1  # scroll pages fetched in advance
+
+    fetch_ordered = False  # Perceval fetches the items in updated_on order
+
     @classmethod
     def add_params(cls, cmdline_parser):
         """ Shared params in all backends """
@@ -52,12 +64,29 @@ class ElasticOcean(object):
         self.from_date = from_date  # fetch from_date
         self.fetch_cache = fetch_cache  # fetch from cache
         self.project = project  # project to be used for this data source
+        self.elastic_slice = None  # (slice id, total slices) to be read
+        self.elastic_source = None  # fields of the items read (None: all)
+        self.elastic_timestamp = None  # (from timestamp, ids to skip) if sorted
+
+    def set_source_fields(self, fields):
+        """ Read only these fields from the items (None for all of them) """
+        self.elastic_source = fields
+
+    def set_timestamp_order(self, from_timestamp=None, skip_ids=None):
+        """ Iterate the items sorted by metadata__timestamp, from_timestamp
+            included, but for the items with ids in skip_ids """
+        self.elastic_timestamp = (from_timestamp, skip_ids or [])
+
+    def set_slice(self, slice_id, slices):
+        """ Iterate only the items in slice_id of the index split in slices """
+        self.elastic_slice = (slice_id, slices)
 
     def set_elastic(self, elastic):
         """ Elastic used to store last data source state """
         self.elastic = elastic
 
-    def get_field_date(self):
+    @classmethod
+    def get_field_date(cls):
         """ Field with the update in the JSON items. Now the same in all. """
         return "metadata__updated_on"
 
@@ -96,165 +125,267 @@ class ElasticOcean(object):
         # Also add timestamp used in incremental enrichment
         item['metadata__timestamp'] = timestamp.isoformat()
 
-    def feed(self, from_date=None):
-        """ Feed data in Elastic from Perceval """
-
-        # Always filter by origin to support multi origin indexes
-        filter_ = {"name":"origin",
-                   "value":self.perceval_backend.origin}
-        self.last_update = self.get_last_update_from_es(filter_)
+    def _feed_item(self, item):
+        """ Prepare a fetched item for Elastic. None if it must be dropped """
+
+        # print("%s %s" % (item['url'], item['lastUpdated_date']))
+        # Add date field for incremental analysis if needed
+        self.add_update_date(item)
+        self._fix_item(item)
+        if self.project:
+            item['project'] = self.project
+        if self.drop_item(item):
+            return None
+        return item
+
+    def _has_resuming(self):
+        """ The Perceval backend can fetch from an item offset """
+        has_resuming = getattr(self.perceval_backend, "has_resuming", None)
+        return bool(has_resuming and has_resuming())
+
+    def feed(self, from_date=None, last_updates=None):
+        """ Feed data in Elastic from Perceval
+
+            last_updates has the last update of all the origins in the index
+            if already read (ElasticSearch.get_last_dates). If the last feed
+            was interrupted, it goes on from its checkpoint.
+        """
+
+        origin = self.perceval_backend.origin
+        if last_updates is not None and last_updates.is_known(origin):
+            self.last_update = last_updates.get(origin)
+        else:
+            if last_updates is not None:
+                logging.info("Last update for %s not read with all the "
+                             "origins: reading it" % (origin))
+            # Always filter by origin to support multi origin indexes
+            filter_ = {"name":"origin",
+                       "value":self.perceval_backend.origin}
+            self.last_update = self.get_last_update_from_es(filter_)
         last_update = self.last_update
         # last_update = '2015-12-28 18:02:00'
         if from_date:
             # Forced from backend command line.
             last_update = from_date
 
+        checkpoint = None
+        offset = None
+        if ConfOcean.elastic and not self.fetch_cache:
+            checkpoint = FeedCheckpoint(self.elastic.index,
+                                        self.perceval_backend.origin,
+                                        self.fetch_ordered)
+            # Not for a new index (clean) without the items already fetched
+            if not from_date and self.last_update and checkpoint.load():
+                last_update = checkpoint.get_from_date()
+                if checkpoint.offset is not None and self._has_resuming():
+                    offset = checkpoint.offset
+                logging.info("Resuming interrupted feed (offset %s)" % (offset))
+            checkpoint.start(last_update)
+
         logging.info("Incremental from: %s" % (last_update))
 
         task_init = datetime.now()
 
-        items_pack = []  # to feed item in packs
-        drop = 0
+        # Packets are sent in order while fetching the next items. The
+        # checkpoint is saved once the items before a mark are stored.
+        commit = checkpoint.commit if checkpoint else None
+        bulk = BulkWriter(self.elastic, ordered=True, commit=commit)
+        field_id = self.get_field_unique_id()
         if self.fetch_cache:
             items = self.perceval_backend.fetch_from_cache()
         else:
-            if last_update:
+            if offset is not None:
+                items = self.perceval_backend.fetch(offset=offset)
+            elif last_update:
                 # Perceval backend from_date must not include timezone
                 # It always uses the server datetime
                 last_update = last_update.replace(tzinfo=None)
                 items = self.perceval_backend.fetch(from_date=last_update)
             else:
                 items = self.perceval_backend.fetch()
-        for item in items:
-            # print("%s %s" % (item['url'], item['lastUpdated_date']))
-            # Add date field for incremental analysis if needed
-            self.add_update_date(item)
-            self._fix_item(item)
-            if self.project:
-                item['project'] = self.project
-            if len(items_pack) >= self.elastic.max_items_bulk:
-                self._items_to_es(items_pack)
-                items_pack = []
-            if not self.drop_item(item):
-                items_pack.append(item)
-            else:
-                drop +=1
-        self._items_to_es(items_pack)
+        # Fetch, fix and store the items in parallel stages
+        pipeline = Pipeline("feed " + self.perceval_backend.origin, items,
+                            [("fix", self._feed_item)])
+
+        with bulk:
+            # Items already fetched are stored also if the fetch fails
+            for item in pipeline:
+                bulk.add(item, item[field_id])
+                if checkpoint:
+                    bulk.add_mark(checkpoint.mark(item))
+        total = bulk.total
+        if bulk.stats['failed'] > bulk.stats['undelivered']:
+            # Sending them again would fail the same way (mappings, parsing)
+            logging.error("%i items from %s not stored because of errors in "
+                          "them" % (bulk.stats['failed'] - bulk.stats['undelivered'],
+                                    self.perceval_backend.origin))
+        if checkpoint and bulk.stats['undelivered'] == 0:
+            # All the items fetched are stored (or can't be)
+            checkpoint.remove()
+        elif checkpoint:
+            logging.warning("Items not delivered: next feed for %s resumes "
+                            "from the checkpoint" % (self.perceval_backend.origin))
+        drop = pipeline.stages[0].items - pipeline.stages[1].items
+
+        if not self.elastic.refresh_bulk:
+            # Make visible in searches all the items just once
+            self.elastic.refresh()
 
 
         total_time_min = (datetime.now()-task_init).total_seconds()/60
 
+        logging.info("Added %i items to %s" % (total, self.elastic.index_url))
         logging.debug("Dropped %i items using drop_item filter" % (drop))
         logging.info("Finished in %.2f min" % (total_time_min))
 
         return self
 
 
-    def _items_to_es(self, json_items):
-        """ Append items JSON to ES (data source state) """
-
-        if len(json_items) == 0:
-            return
-
-        logging.info("Adding items to Ocean for %s (%i items)" %
-                      (self, len(json_items)))
-
-        field_id = self.get_field_unique_id()
-
-        self.elastic.bulk_upload_sync(json_items, field_id)
-
     # Iterator
-    def _get_elastic_items(self):
-        """ Get the items from the index related to the backend """
-
-        url = self.elastic.index_url
-        # 1 minute to process the results of size items
-        # In gerrit enrich with 500 items per page we need >1 min
-        max_process_items_pack_time = "3m"  # 3 minutes
-        url += "/_search?scroll=%s&size=%i" % (max_process_items_pack_time,
-                                               self.elastic_page)
-
-        if self.elastic_scroll_id:
-            """ Just continue with the scrolling """
-            url = self.elastic.url
-            url += "/_search/scroll"
-            scroll_data = {
-                "scroll" : max_process_items_pack_time,
-                "scroll_id" : self.elastic_scroll_id
+    def _get_elastic_query(self, sliced=False):
+        """ Query for the items in the index related to the backend """
+
+        filters = "{}"
+        # If origin Always filter by origin to support multi origin indexes
+        if self.perceval_backend.origin:
+            filters = '''
+                {"term":
+                    { "origin" : "%s"  }
                 }
-            r = requests.post(url, data=json.dumps(scroll_data))
-        else:
-            filters = "{}"
-            # If origin Always filter by origin to support multi origin indexes
-            if self.perceval_backend.origin:
-                filters = '''
-                    {"term":
-                        { "origin" : "%s"  }
-                    }
-                ''' % (self.perceval_backend.origin)
+            ''' % (self.perceval_backend.origin)
 
-            if self.from_date:
-                date_field = self.get_field_date()
-                from_date = self.from_date.isoformat()
+        if self.from_date:
+            date_field = self.get_field_date()
+            from_date = self.from_date.isoformat()
 
+            filters += '''
+                , {"range":
+                    {"%s": {"gte": "%s"}}
+                }
+            ''' % (date_field, from_date)
+
+        sort_query = ""
+        must_not = "[]"
+        if self.elastic_timestamp:
+            from_timestamp, skip_ids = self.elastic_timestamp
+            sort_query = '''
+                "sort": [{"metadata__timestamp": {"order": "asc"}}],
+            '''
+            if from_timestamp:
                 filters += '''
                     , {"range":
-                        {"%s": {"gte": "%s"}}
-                    }
-                ''' % (date_field, from_date)
-
-            query = """
-            {
-                "query": {
-                    "bool": {
-                        "must": [%s]
+                        {"metadata__timestamp": {"gte": "%s"}}
                     }
+                ''' % (from_timestamp)
+            if skip_ids:
+                # Items with from_timestamp already processed
+                must_not = json.dumps([{"ids": {"values": skip_ids}}])
+
+        slice_query = ""
+        if sliced and self.elastic_slice:
+            # Sliced scroll: the slices can be read in parallel
+            slice_query = '''
+                "slice": {"id": %i, "max": %i},
+            ''' % self.elastic_slice
+
+        source_query = ""
+        if self.elastic_source is not None:
+            # Don't transfer the fields not used
+            source_query = '''
+                "_source": %s,
+            ''' % (json.dumps(self.elastic_source or False))
+
+        query = """
+        {
+            %s %s %s
+            "query": {
+                "bool": {
+                    "must": [%s],
+                    "must_not": %s
                 }
             }
-            """ % (filters)
+        }
+        """ % (slice_query, source_query, sort_query, filters, must_not)
 
-            logging.debug("%s %s" % (url, query))
+        return query
 
-            r = requests.post(url, data=query)
+    def _get_elastic_page_size(self, query):
+        """ Items per scroll page to get pages of around elastic_page_bytes """
 
-        items = []
-        try:
-            rjson = r.json()
-        except:
-            logging.warning("No JSON found in %s" % (r.text))
-            logging.warning("No results found from %s" % (url))
+        url = self.elastic.index_url
+        url += "/_search?size=%i" % (self.elastic_page_probe)
 
-        if rjson and "_scroll_id" in rjson:
-            self.elastic_scroll_id = rjson["_scroll_id"]
-        else:
-            self.elastic_scroll_id = None
+        r = self.elastic.requests.post(url, data=query)
+        hits = codec.loads(r.content).get("hits", {}).get("hits", [])
+        if not hits:
+            return self.elastic_page_min
 
-        if rjson and "hits" in rjson:
-            for hit in rjson["hits"]["hits"]:
-                items.append(hit['_source'])
-        else:
-            logging.warning("No results found from %s" % (url))
+        item_bytes = len(r.content) / len(hits)
+        page = int(self.elastic_page_bytes / item_bytes)
+        page = max(self.elastic_page_min, min(page, self.elastic_page_max))
 
-        return items
+        logging.debug("Scroll page of %i items (%i bytes per item) for %s" %
+                      (page, item_bytes, self.elastic.index_url))
 
-    def __iter__(self):
+        return page
 
-        self.elastic_scroll_id = None
-        # In large projects like Eclipse commits, 100 is too much
-        # self.elastic_page = 100
-        self.elastic_page = 10
-        self.iter_items = self._get_elastic_items()
+    def _get_elastic_pages(self):
+        """ Get the pages of items from the index related to the backend """
 
-        return self
+        # Time to process a page and get the next one
+        # In gerrit enrich with 500 items per page we need >1 min
+        max_process_items_pack_time = "10m"
 
-    def __next__(self):
+        page_size = self._get_elastic_page_size(self._get_elastic_query())
+        query = self._get_elastic_query(sliced=True)
 
-        if len(self.iter_items) > 0:
-            return self.iter_items.pop()
-        else:
-            if self.elastic_scroll_id:
-                self.iter_items = self._get_elastic_items()
-            if len(self.iter_items) > 0:
-                return self.__next__()
-            else:
-                raise StopIteration
+        url = self.elastic.index_url
+        url += "/_search?scroll=%s&size=%i" % (max_process_items_pack_time,
+                                               page_size)
+        logging.debug("%s %s" % (url, query))
+        r = self.elastic.requests.post(url, data=query)
+
+        scroll_id = None
+        try:
+            while True:
+                try:
+                    rjson = codec.loads(r.content)
+                except ValueError:
+                    logging.warning("No JSON found in %s" % (r.text))
+                    logging.warning("No results found from %s" % (url))
+                    break
+
+                scroll_id = rjson.get("_scroll_id")
+
+                if "hits" not in rjson:
+                    logging.warning("No results found from %s" % (url))
+                    break
+                hits = rjson["hits"]["hits"]
+                if not hits:
+                    break
+
+                yield [hit.get('_source', {}) for hit in hits]
+
+                if not scroll_id:
+                    break
+                # Just continue with the scrolling
+                url = self.elastic.url + "/_search/scroll"
+                scroll_data = {
+                    "scroll" : max_process_items_pack_time,
+                    "scroll_id" : scroll_id
+                    }
+                r = self.elastic.requests.post(url, data=json.dumps(scroll_data))
+        finally:
+            if scroll_id:
+                # Free the scroll context in ES
+                url = self.elastic.url + "/_search/scroll"
+                self.elastic.requests.delete(url, data=json.dumps({"scroll_id": [scroll_id]}))
+
+    def __iter__(self):
+        # The next page is fetched while the current one is processed
+        pages = Pipeline("scroll " + self.elastic.index_url,
+                         self._get_elastic_pages(),
+                         queue_size=self.elastic_prefetch_pages)
+        for page in pages:
+            for item in page:
+                yield item
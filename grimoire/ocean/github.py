@@ -29,5 +29,7 @@ from grimoire.ocean.elastic import ElasticOcean
 class GitHubOcean(ElasticOcean):
     """GitHub Ocean feeder"""
 
+    fetch_ordered = True  # sorted by update date
+
     def _fix_item(self, item):
         item["ocean-unique-id"] = str(item["data"]["id"])+"_"+item['origin']
@@ -0,0 +1,171 @@
+#!/usr/bin/python3
+# -*- coding: utf-8 -*-
+#
+# Grimoire pipeline of threaded stages
+#
+# Copyright (C) 2015 Bitergia
+#
+# This program is free software; you can redistribute it and/or modify
+# it under the terms of the GNU General Public License as published by
+# the Free Software Foundation; either version 3 of the License, or
+# (at your option) any later version.
+#
+# This program is distributed in the hope that it will be useful,
+# but WITHOUT ANY WARRANTY; without even the implied warranty of
+# MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE. See the
+# GNU General Public License for more details.
+#
+# You should have received a copy of the GNU General Public License
+# along with this program; if not, write to the Free Software
+# Foundation, Inc., 59 Temple Place - Suite 330, Boston, MA 02111-1307, USA.
+#
+# Authors:
+#   Alvaro del Castillo San Felix <acs@bitergia.com>
+#
+
+import logging
+from queue import Queue, Empty, Full
+from threading import Event, Thread
+from time import time
+
+END = object()  # marks the end of the items in a queue
+
+
+class PipelineStage(object):
+    """ Stage of a pipeline and its stats """
+
+    def __init__(self, name, func=None, queue=None):
+        self.name = name
+        self.func = func  # transform for each item (None: copy them)
+        self.queue = queue  # output queue (None for the sink)
+        self.items = 0  # items produced
+        self.max_depth = 0  # max items waiting in the output queue
+        self.start = None
+
+    def get_stats(self):
+        elapsed = time() - self.start if self.start else 0
+        stats = {
+            "items": self.items,
+            "items_sec": self.items / elapsed if elapsed > 0 else 0,
+            "queue": self.queue.qsize() if self.queue else 0,
+            "max_queue": self.max_depth
+        }
+        return stats
+
+
+class Pipeline(object):
+    """ Items flow from a producer through transform stages to a sink
+
+        The producer (iterating the source) and each transform run in their
+        own thread, connected by bounded queues so a slow stage makes the
+        previous ones wait. Iterating the pipeline is the sink: it gets the
+        transformed items in the caller thread.
+
+        A transform returns the new item or None to drop it. If a stage
+        fails, the pipeline is stopped and the error raised to the sink.
+    """
+
+    def __init__(self, name, source, transforms=None, queue_size=1000,
+                 report_seconds=60):
+        self.name = name
+        self.source = source
+        self.queue_size = queue_size
+        self.report_seconds = report_seconds
+
+        self.stages = [PipelineStage("produce", queue=Queue(queue_size))]
+        for tname, func in (transforms or []):
+            self.stages.append(PipelineStage(tname, func, Queue(queue_size)))
+        self.sink = PipelineStage("sink")
+
+        self.stop = Event()
+        self.error = None
+        self.threads = []
+
+    def _put(self, stage, item):
+        """ Put item in the stage output queue. False if pipeline stopped """
+
+        while True:
+            try:
+                stage.queue.put(item, timeout=0.5)
+                break
+            except Full:
+                if self.stop.is_set():
+                    return False
+        stage.max_depth = max(stage.max_depth, stage.queue.qsize())
+        return True
+
+    def _get_items(self, queue):
+        """ Items from queue until the end of them or pipeline stopped """
+
+        while True:
+            try:
+                item = queue.get(timeout=0.5)
+            except Empty:
+                if self.stop.is_set():
+                    return
+                continue
+            if item is END:
+                return
+            yield item
+
+    def _run_stage(self, stage, items):
+        stage.start = time()
+        try:
+            for item in items:
+                if stage.func:
+                    item = stage.func(item)
+                    if item is None:
+                        continue
+                stage.items += 1
+                if not self._put(stage, item):
+                    break
+        except Exception as ex:
+            logging.error("Error in %s %s stage: %s" % (self.name,
+                                                        stage.name, ex))
+            self.error = ex
+            self.stop.set()
+        finally:
+            if hasattr(items, "close"):
+                # Release the resources of generators not consumed
+                items.close()
+            self._put(stage, END)
+
+    def report(self):
+        """ Log the throughput and queue depth of all the stages """
+
+        for stage in self.stages + [self.sink]:
+            stats = stage.get_stats()
+            logging.info("%s %s: %i items (%.1f items/s) queue %i (max %i)" %
+                         (self.name, stage.name, stats['items'],
+                          stats['items_sec'], stats['queue'],
+                          stats['max_queue']))
+
+    def __iter__(self):
+        items = self.source
+        for stage in self.stages:
+            thread = Thread(target=self._run_stage, args=(stage, items),
+                            name=self.name+"-"+stage.name, daemon=True)
+            self.threads.append(thread)
+            items = self._get_items(stage.queue)
+
+        for thread in self.threads:
+            thread.start()
+
+        self.sink.start = time()
+        last_report = time()
+        try:
+            for item in items:
+                yield item
+                self.sink.items += 1
+                if time() - last_report > self.report_seconds:
+                    self.report()
+                    last_report = time()
+        finally:
+            # Sink finished or failed: stop all the stages
+            self.stop.set()
+            for thread in self.threads:
+                thread.join()
+
+        self.report()
+        if self.error:
+            raise self.error
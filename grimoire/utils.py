@@ -24,7 +24,6 @@
 #
 
 import argparse
-from dateutil import parser
 import logging
 import sys
 
@@ -61,6 +60,7 @@ from perceval.backends.stackexchange import StackExchange, StackExchangeCommand
 from perceval.backends.jira import Jira, JiraCommand
 from perceval.backends.jenkins import Jenkins, JenkinsCommand
 
+from grimoire.elk.dates import parse_date
 from grimoire.elk.elastic import ElasticSearch
 from grimoire.elk.elastic import ElasticConnectException
 
@@ -160,9 +160,31 @@ def get_params_parser():
                         help="Only enrich items")
     parser.add_argument('--index', help="Ocean index name")
     parser.add_argument('--index-enrich', dest="index_enrich", help="Ocean enriched index name")
-    parser.add_argument('--db-projects-map', help="Projects Mapping DB")
+    parser.add_argument('--db-projects-map',
+                        help="Projects Mapping DB or JSON/CSV file")
     parser.add_argument('--project', help="Project for the repository (origin)")
     parser.add_argument('--db-sortinghat', help="SortingHat DB")
+    parser.add_argument('--bulk-workers', dest='bulk_workers', type=int,
+                        default=0, help="threads sending bulk packets to ES")
+    parser.add_argument('--es-pool-size', dest='es_pool_size', type=int,
+                        help="max keep-alive connections to ES (10 default)")
+    parser.add_argument('--es-timeout', dest='es_timeout', type=float,
+                        help="seconds waiting for ES responses (300 default)")
+    parser.add_argument('--bulk-refresh', dest='bulk_refresh',
+                        choices=['wait_for', 'true'],
+                        help="refresh for each bulk packet (default: once per feed)")
+    parser.add_argument('--enrich-slices', dest='enrich_slices', type=int,
+                        default=0, help="slices of the ocean index enriched in parallel processes (not with --workers)")
+    parser.add_argument('--workers', type=int, default=0,
+                        help="processes enriching items in parallel (not with --enrich-slices)")
+    parser.add_argument('--identities-cache-size', dest='identities_cache_size',
+                        type=int, default=100000,
+                        help="max entries in each Sorting Hat cache (100000 default)")
+    parser.add_argument('--merge-identities', dest='merge_identities',
+                        action='store_true',
+                        help="merge in Sorting Hat the identities matched")
+    parser.add_argument('--identities-store', dest='identities_store',
+                        help="sqlite file to keep Sorting Hat identities between runs")
     parser.add_argument('backend', help=argparse.SUPPRESS)
     parser.add_argument('backend_args', nargs=argparse.REMAINDER,
                         help=argparse.SUPPRESS)
@@ -188,8 +210,8 @@ def get_time_diff_days(start_txt, end_txt):
     if start_txt is None or end_txt is None:
         return None
 
-    start = parser.parse(start_txt)
-    end = parser.parse(end_txt)
+    start = parse_date(start_txt)
+    end = parse_date(end_txt)
 
     seconds_day = float(60*60*24)
     diff_days = \
@@ -0,0 +1,77 @@
+#!/usr/bin/python3
+# -*- coding: utf-8 -*-
+#
+# Tests for the matching of identities to be merged in Sorting Hat
+#
+# Copyright (C) 2015 Bitergia
+#
+# This program is free software; you can redistribute it and/or modify
+# it under the terms of the GNU General Public License as published by
+# the Free Software Foundation; either version 3 of the License, or
+# (at your option) any later version.
+#
+# This program is distributed in the hope that it will be useful,
+# but WITHOUT ANY WARRANTY; without even the implied warranty of
+# MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE. See the
+# GNU General Public License for more details.
+#
+# You should have received a copy of the GNU General Public License
+# along with this program; if not, write to the Free Software
+# Foundation, Inc., 59 Temple Place - Suite 330, Boston, MA 02111-1307, USA.
+#
+# Authors:
+#   Alvaro del Castillo San Felix <acs@bitergia.com>
+#
+
+import os
+import sys
+import unittest
+
+sys.path.insert(0, os.path.join(os.path.dirname(__file__), ".."))
+
+from grimoire.elk.sortinghat import IdentityMatcher
+
+
+class TestIdentityMatcher(unittest.TestCase):
+
+    def match(self, identities):
+        """ Groups matched (sorted uuids) for (uuid, email, name) """
+
+        matcher = IdentityMatcher()
+        for i, (uuid, email, name) in enumerate(identities):
+            matcher.add(str(i), uuid, email, name)
+        return sorted(sorted(group) for group in matcher.match())
+
+    def test_same_email(self):
+        groups = self.match([("u1", "jsmith@example.com", "John Smith"),
+                             ("u2", "JSmith@example.com", "jsmith")])
+        self.assertEqual(groups, [["u1", "u2"]])
+
+    def test_same_name(self):
+        groups = self.match([("u1", "john@example.com", "John Smith"),
+                             ("u2", "smith@other.org", "Smith, John")])
+        self.assertEqual(groups, [["u1", "u2"]])
+
+    def test_local_part_same_first_name(self):
+        groups = self.match([("u1", "david@foo.com", "David Smith"),
+                             ("u2", "david@bar.org", "David Jones")])
+        self.assertEqual(groups, [])
+
+    def test_local_part_same_surname(self):
+        groups = self.match([("u1", "jsmith@x.org", "John Smith"),
+                             ("u2", "jsmith@y.org", "Jane Smith")])
+        self.assertEqual(groups, [])
+
+    def test_local_part_same_full_name(self):
+        groups = self.match([("u1", "jsmith@x.org", "John A. Smith"),
+                             ("u2", "jsmith@y.org", "John Smith")])
+        self.assertEqual(groups, [["u1", "u2"]])
+
+    def test_single_name(self):
+        groups = self.match([("u1", "john@x.org", "John"),
+                             ("u2", "jdoe@y.org", "John")])
+        self.assertEqual(groups, [])
+
+
+if __name__ == "__main__":
+    unittest.main()
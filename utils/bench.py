@@ -0,0 +1,161 @@
+#!/usr/bin/python3
+# -*- coding: utf-8 -*-
+#
+# Micro-benchmarks with real items from Ocean indexes
+#
+# Copyright (C) 2015 Bitergia
+#
+# This program is free software; you can redistribute it and/or modify
+# it under the terms of the GNU General Public License as published by
+# the Free Software Foundation; either version 3 of the License, or
+# (at your option) any later version.
+#
+# This program is distributed in the hope that it will be useful,
+# but WITHOUT ANY WARRANTY; without even the implied warranty of
+# MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE. See the
+# GNU General Public License for more details.
+#
+# You should have received a copy of the GNU General Public License
+# along with this program; if not, write to the Free Software
+# Foundation, Inc., 59 Temple Place - Suite 330, Boston, MA 02111-1307, USA.
+#
+# Authors:
+#   Alvaro del Castillo San Felix <acs@bitergia.com>
+#
+
+import argparse
+import json
+import logging
+from time import time
+
+from dateutil import parser
+
+from grimoire.elk import codec
+from grimoire.elk.dates import parse_date
+from grimoire.elk.elastic import ElasticSearch
+from grimoire.ocean.elastic import ElasticOcean
+
+
+def get_params():
+    ''' Get params definition from ElasticOcean '''
+    parser = argparse.ArgumentParser()
+    ElasticOcean.add_params(parser)
+
+    parser.add_argument("--index", required=True,
+                        help="Ocean index with the items to be used")
+    parser.add_argument("--items", type=int, default=1000,
+                        help="items read from the index (1000 default)")
+    parser.add_argument("--rounds", type=int, default=5,
+                        help="times each benchmark is run (5 default)")
+    parser.add_argument('-g', '--debug', dest='debug', action='store_true')
+    parser.add_argument('bench', choices=['codec', 'dates'],
+                        help="benchmark to run")
+
+    args = parser.parse_args()
+
+    return args
+
+def get_items(elastic_url, index, size):
+    """ Get size items from an ocean index """
+
+    elastic = ElasticSearch(elastic_url, index)
+    url = elastic.index_url + "/_search?size=%i" % (size)
+    r = elastic.requests.get(url)
+
+    return [hit['_source'] for hit in r.json()['hits']['hits']]
+
+def timeit(func, items, rounds):
+    """ Best time in rounds of calling func for all items """
+
+    best = None
+    for i in range(rounds):
+        task_init = time()
+        for item in items:
+            func(item)
+        elapsed = time() - task_init
+        if best is None or elapsed < best:
+            best = elapsed
+    return best
+
+def report(name, items, std_time, fast_time, fast_name, std_name="json"):
+    logging.info("%s %i items: %s %.3f sec, %s %.3f sec (x%.1f)" %
+                 (name, len(items), std_name, std_time, fast_name, fast_time,
+                  std_time / fast_time if fast_time else 0))
+
+def bench_codec(items, rounds):
+    """ stdlib json vs grimoire codec encoding and decoding items """
+
+    def std_dumps(item):
+        return json.dumps(item).encode('utf-8')
+
+    report("encode", items, timeit(std_dumps, items, rounds),
+           timeit(codec.dumps, items, rounds), codec.name)
+
+    encoded = [codec.dumps(item) for item in items]
+
+    def std_loads(data):
+        return json.loads(data.decode('utf-8'))
+
+    report("decode", encoded, timeit(std_loads, encoded, rounds),
+           timeit(codec.loads, encoded, rounds), codec.name)
+
+def get_dates(item, dates=None):
+    """ Strings in item (nested too) which look like dates """
+
+    if dates is None:
+        dates = []
+    values = item.values() if isinstance(item, dict) else item
+    for value in values:
+        if isinstance(value, (dict, list)):
+            get_dates(value, dates)
+        elif isinstance(value, str) and 10 <= len(value) <= 40 and \
+            sum(c.isdigit() for c in value) >= 6:
+            try:
+                parser.parse(value)
+                dates.append(value)
+            except (ValueError, OverflowError):
+                pass
+    return dates
+
+def bench_dates(items, rounds):
+    """ dateutil vs grimoire parse_date with the dates in items """
+
+    dates = []
+    for item in items:
+        get_dates(item, dates)
+
+    for date in set(dates):
+        if parse_date(date) != parser.parse(date):
+            logging.warning("Different parsing for %s: %s %s" %
+                            (date, parse_date(date), parser.parse(date)))
+
+    def parse_date_nocache(date):
+        return parse_date.__wrapped__(date)
+
+    std_time = timeit(parser.parse, dates, rounds)
+    report("parse", dates, std_time, timeit(parse_date_nocache, dates, rounds),
+           "parse_date (no cache)", "dateutil")
+    parse_date.cache_clear()
+    report("parse", dates, std_time, timeit(parse_date, dates, 1),
+           "parse_date", "dateutil")
+    logging.info("parse_date cache: %s" % (parse_date.cache_info(),))
+
+
+if __name__ == '__main__':
+
+    args = get_params()
+
+    if args.debug:
+        logging.basicConfig(level=logging.DEBUG, format='%(asctime)s %(message)s')
+    else:
+        logging.basicConfig(level=logging.INFO, format='%(asctime)s %(message)s')
+    logging.getLogger("urllib3").setLevel(logging.WARNING)
+    logging.getLogger("requests").setLevel(logging.WARNING)
+
+    items = get_items(args.elastic_url, args.index, args.items)
+    logging.info("Read %i items from %s" % (len(items), args.index))
+
+    if args.bench == 'codec':
+        bench_codec(items, args.rounds)
+    elif args.bench == 'dates':
+        bench_dates(items, args.rounds)
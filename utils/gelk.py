@@ -34,6 +34,7 @@ from grimoire.elk.elastic import ElasticConnectException
 from grimoire.elk.bugzilla import BugzillaEnrich
 from grimoire.elk.gerrit import GerritEnrich
 from grimoire.elk.github import GitHubEnrich
+from grimoire.elk.identities import IdentityCollector
 from grimoire.elk.sortinghat import SortingHat
 
 from grimoire.ocean.bugzilla import BugzillaOcean
@@ -139,7 +140,7 @@ if __name__ == '__main__':
 
 
         items = []
-        new_identities = []
+        new_identities = IdentityCollector()
         items_count = 0
 
         for item in ocean_backend:
@@ -149,10 +150,7 @@ if __name__ == '__main__':
                 items = []
             items.append(item)
             # Get identities from new items to be added to SortingHat
-            identities = ocean_backend.get_identities(item)
-            for identity in identities:
-                if identity not in new_identities:
-                    new_identities.append(identity)
+            new_identities.add_all(ocean_backend.get_identities(item))
             items_count += 1
         enrich_backend.enrich_items(items)
 
@@ -161,6 +159,7 @@ if __name__ == '__main__':
         logging.info("Total new identities to be checked %i" % len(new_identities))
 
         merged_identities = SortingHat.add_identities(new_identities, backend_name)
+        new_identities.close()
 
         # Redo enrich for items with new merged identities
 
@@ -26,13 +26,13 @@
 import argparse
 from datetime import datetime
 import logging
-import requests
 
 
 from grimoire.ocean.elastic import ElasticOcean
 from grimoire.ocean.conf import ConfOcean
 from grimoire.utils import get_elastic, config_logging, get_connector_from_name
 
+from grimoire.elk.identities import IdentityCollector
 from grimoire.elk.sortinghat import SortingHat
 
 
@@ -54,7 +54,7 @@ def get_perceval_params(url, index):
     elastic = get_elastic(url, ConfOcean.get_index())
     ConfOcean.set_elastic(elastic)
 
-    r = requests.get(elastic.index_url+"/repos/"+index)
+    r = elastic.requests.get(elastic.index_url+"/repos/"+index)
 
     params = r.json()['_source']['params']
 
@@ -62,13 +62,9 @@ def get_perceval_params(url, index):
 
 def get_identities(obackend):
     """ Get identities from items in ocean backend and remove duplicates """
-    identities = []
-    unique_identities = []
+    unique_identities = IdentityCollector()
     for item in obackend:
-        identities = obackend.get_identities(item)
-        for identity in identities:
-            if identity not in unique_identities:
-                unique_identities.append(identity)
+        unique_identities.add_all(obackend.get_identities(item))
     return unique_identities
 
 
@@ -102,4 +98,5 @@ if __name__ == '__main__':
 
         # Add the identities to Sorting Hat
 
-        print ("Total identities processed: %i" % (len(identities)))
\ No newline at end of file
+        print ("Total identities processed: %i" % (len(identities)))
+        identities.close()
\ No newline at end of file
@@ -26,7 +26,6 @@
 import argparse
 from datetime import datetime
 import logging
-import requests
 import sys
 
 from grimoire.elk.elastic import ElasticSearch, ElasticConnectException, ElasticWriteException
@@ -86,7 +85,7 @@ def list_repos():
     for repo_id in ConfOcean.get_repos_ids():
         elastic = get_elastic()
         url = elastic.index_url + "/repos/" + repo_id
-        r = requests.get(url)
+        r = elastic.requests.get(url)
         repo = r.json()['_source']
         print ("%s %s %s" % (repo_id, repo['repo_update'], repo['success']))
 
@@ -95,7 +94,7 @@ def remove_repo(repo_id):
     logging.info("Removing repo: %s" % (repo_id))
     elastic = get_elastic()
     url = elastic.index_url + "/repos/" + repo_id
-    r = requests.delete(url)
+    r = elastic.requests.delete(url)
 
     if r.status_code == 200:
         logging.info("Done")
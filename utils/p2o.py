@@ -30,7 +30,10 @@ from time import time, sleep
 
 from grimoire.arthur import feed_backend, enrich_backend
 
+from grimoire.elk.elastic import ElasticSearch
+from grimoire.elk.enrich import Enrich
 from grimoire.ocean.conf import ConfOcean
+from grimoire.ocean.elastic import ElasticOcean
 
 from grimoire.utils import get_elastic
 from grimoire.utils import get_params_parser, config_logging
@@ -46,6 +49,9 @@ def get_params():
 
     args = parser.parse_args()
 
+    if args.workers > 1 and args.enrich_slices > 1:
+        parser.error("--workers and --enrich-slices can't be used together")
+
     return args
 
 
@@ -59,10 +65,18 @@ def feed_backends(url, clean, debug = False, redis = None):
 
     q = Queue('update', connection=Redis(redis), async=async_)
 
+    last_updates = {}  # index -> last update of each origin in it
+
     for repo in ConfOcean.get_repos():
+        if not clean and repo['index'] not in last_updates:
+            # Last updates of all the origins in the index in one query
+            elastic_ocean = ElasticSearch(url, repo['index'])
+            field = ElasticOcean.get_field_date()
+            last_updates[repo['index']] = elastic_ocean.get_last_dates(field)
         task_feed = q.enqueue(feed_backend, url, clean, fetch_cache,
                               repo['backend_name'], repo['backend_params'],
-                              repo['index'], repo['index_enrich'], repo['project'])
+                              repo['index'], repo['index_enrich'], repo['project'],
+                              last_updates.get(repo['index']))
         logging.info("Queued job")
         logging.info(task_feed)
 
@@ -90,6 +104,8 @@ def loop_update(min_update_time, url, clean, debug, redis, enrich=False,
                 db_projects_map=None, db_sortinghat=None):
 
     while True:
+        # Last dates of the origins are read once per index in each cycle
+        ElasticSearch.cache_last_dates()
         ustart_feed = time()
         feed_backends(url, clean, debug, redis)
         update_time_feed = int(time()-ustart_feed)
@@ -119,6 +135,16 @@ if __name__ == '__main__':
 
     url = args.elastic_url
 
+    timeout = None
+    if args.es_timeout:
+        timeout = (ElasticSearch.timeout[0], args.es_timeout)  # read timeout
+    ElasticSearch.configure_session(pool_maxsize=args.es_pool_size,
+                                    timeout=timeout)
+    ElasticSearch.bulk_workers = args.bulk_workers
+    ElasticSearch.refresh_bulk = args.bulk_refresh
+    Enrich.set_identities_cache_size(args.identities_cache_size)
+    Enrich.set_identities_store(args.identities_store)
+
     clean = args.no_incremental
     if args.fetch_cache:
         clean = True
@@ -149,13 +175,17 @@ if __name__ == '__main__':
                                        args.index, args.index_enrich,
                                        args.db_projects_map, args.db_sortinghat,
                                        args.no_incremental,
+                                       args.enrich_slices, args.workers,
+                                       args.merge_identities,
                                        depends_on=task_feed)
                 else:
                     result = q.enqueue(enrich_backend, url, clean,
                                        args.backend, args.backend_args,
                                        args.index, args.index_enrich,
                                        args.db_projects_map, args.db_sortinghat,
-                                       args.no_incremental)
+                                       args.no_incremental,
+                                       args.enrich_slices, args.workers,
+                                       args.merge_identities)
                 logging.info("Queued enrich_backend job")
                 logging.info(result)
 